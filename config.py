@@ -11,8 +11,150 @@ class Config(object):
     LINKING_SERVICE_PORT = "9092"
     LINKING_SERVICE_ENDPOINT = "link"
 
+    # Threads shared by all requests for calls to the classification and linking services
+    SERVICE_CALL_WORKERS = 16
+
     SPARQL_ENDPOINT = "http://geo-qa.cs.upb.de:3030/bremen_geo/sparql"
 
+    # "remote" sends queries to SPARQL_ENDPOINT, "local" answers them from an in-memory, R-tree indexed copy of the
+    # knowledge base dump at LOCAL_KB_DUMP_PATH. Query shapes the local executor does not support go to the remote
+    # endpoint when LOCAL_EXECUTOR_REMOTE_FALLBACK is set.
+    SPARQL_EXECUTOR = "remote"
+    LOCAL_KB_DUMP_PATH = "bremen_geo.nt"
+    LOCAL_EXECUTOR_REMOTE_FALLBACK = True
+
+    # Version of the knowledge base loaded into the endpoint, bump it on every reload
+    KB_VERSION = "1"
+    # N-Triples file written by geoqa.core.topology with precomputed geo:sfTouches/sfContains/sfCrosses relations.
+    # Once its metadata matches KB_VERSION and the dump and the endpoint answers the ASK for its marker triple, the
+    # generated queries look these relations up instead of evaluating geof functions. None disables it.
+    TOPOLOGY_MATERIALIZATION_PATH = None
+
+    # Prefilter targets with the bounding box of the linked entity before exact geof functions are evaluated. The bbox
+    # is inlined as a WKT literal of that entity, so CLASS__ENTITY candidates of different entities no longer share
+    # a template and are not batched by QUERY_BATCHING_ENABLED. Disable it where batching saves more round trips
+    # than the prefilter saves endpoint time.
+    BBOX_PREFILTER_ENABLED = True
+    BBOX_CACHE_SIZE = 10000
+
+    # Proximity queries only consider targets from grid cells within the requested distance of the entity, passed
+    # as a VALUES block unless there are more than PROXIMITY_VALUES_LIMIT of them. Grids are built in the background
+    # on first use of a class, and kept for PROXIMITY_INDEX_CLASSES classes and PROXIMITY_INDEX_TTL seconds.
+    PROXIMITY_INDEX_ENABLED = True
+    PROXIMITY_GRID_CELL_METRES = 500
+    PROXIMITY_VALUES_LIMIT = 500
+    PROXIMITY_INDEX_CLASSES = 256
+    PROXIMITY_INDEX_TTL = 3600
+
+    # Candidate queries of a question are executed in parallel, bounded by the worker count
+    QUERY_EXECUTION_WORKERS = 8
+    # Seconds after which a single candidate query is abandoned
+    QUERY_EXECUTION_TIMEOUT = 30
+    # Candidates differing only in their linked URIs are sent as one query with a VALUES block of up to
+    # QUERY_BATCH_SIZE rows, and the bindings are split back per candidate. Candidates whose bbox prefilter or
+    # proximity VALUES block is specific to their entity never differ only in URIs, so they are executed alone.
+    QUERY_BATCHING_ENABLED = True
+    QUERY_BATCH_SIZE = 20
+
+    # "exhaustive" executes every candidate before ranking. "early_termination" executes candidates by their best
+    # possible score and stops once none of the rest can win, picking the same answer. Only ASK, COUNT and LIMIT
+    # queries have a bounded score, SELECT queries without LIMIT are always executed. It is not used while
+    # ABLATION_RANKING is set.
+    RANKING_MODE = "exhaustive"
+
+    # Results of identical (whitespace normalized) queries are served from memory for SPARQL_CACHE_TTL seconds
+    SPARQL_CACHE_SIZE = 4096
+    SPARQL_CACHE_TTL = 3600
+
+    # Final answers per (question, language, ablation flags), checked before any service is called
+    ANSWER_CACHE_SIZE = 1024
+    ANSWER_CACHE_TTL = 3600
+
+    # POST /cache/invalidate clears the answer, SPARQL, bounding box and proximity grid caches. It requires
+    # CACHE_INVALIDATION_TOKEN in the X-GeoQA-Admin-Token header, or, without a token configured, a local client.
+    # The generation kept in CACHE_GENERATION_PATH carries the invalidation to all other processes, e.g. the
+    # pre-forked workers, before their next request; None limits it to the process serving the request.
+    CACHE_INVALIDATION_TOKEN = None
+    CACHE_GENERATION_PATH = "geoqa.cache_generation"
+
+    # SQLite file persisting classifier and linker responses across restarts and worker processes, None disables it.
+    # Bump the version whenever the Falcon or geo-classifier deployment changes.
+    SERVICE_CACHE_PATH = "service_cache.sqlite3"
+    SERVICE_CACHE_VERSION = "1"
+
+    # spaCy pipeline loaded on the first question. The query generator only reads tags, lemmas and the spacytextblob
+    # polarity, so components it does not need are excluded from loading.
+    SPACY_MODEL = "en_core_web_sm"
+    SPACY_EXCLUDED_COMPONENTS = ["ner"]
+    # Questions parsed per nlp.pipe batch by the batch endpoint, which takes up to QA_BATCH_MAX_QUESTIONS per request
+    SPACY_BATCH_SIZE = 64
+    QA_BATCH_MAX_QUESTIONS = 256
+
+    # Parsed question features kept in memory, they are also persisted in the service response store
+    QUESTION_FEATURES_CACHE_SIZE = 4096
+
+    # Keep-alive connection pools shared by the REST services and the SPARQL endpoint
+    HTTP_POOL_CONNECTIONS = 4
+    HTTP_POOL_SIZE = 16
+    HTTP_CONNECT_TIMEOUT = 3.05
+    HTTP_READ_TIMEOUT = 30
+    # Retries on connection errors and 502/503/504 with jittered exponential backoff, read timeouts are not retried
+    HTTP_MAX_RETRIES = 2
+    HTTP_BACKOFF_FACTOR = 0.3
+
+    # asyncio serving mode (run_async.py): connections per event loop, SPARQL requests in flight per event loop and
+    # threads for spaCy parsing and query generation
+    ASYNC_HTTP_CONNECTION_LIMIT = 100
+    ASYNC_SPARQL_CONCURRENCY = 64
+    ASYNC_NLP_WORKERS = 4
+
+    # Pre-forked serving (run_prefork.py): workers forked from a parent that loaded the models once. The parent
+    # writes PREFORK_READY_FILE once all workers serve, SIGHUP restarts the workers one by one, and stopping workers
+    # get PREFORK_GRACEFUL_TIMEOUT seconds to finish their requests.
+    PREFORK_HOST = "0.0.0.0"
+    PREFORK_PORT = 8080
+    PREFORK_WORKERS = 4
+    PREFORK_READY_FILE = "geoqa.ready"
+    PREFORK_GRACEFUL_TIMEOUT = 30
+
+    # Stage latency histograms and pipeline counters, exposed in the Prometheus text format at /metrics
+    METRICS_ENABLED = True
+
+    # Time budget in seconds of a /qa request, None for no deadline. Clients may ask for another budget with the
+    # time_budget parameter, up to REQUEST_MAX_TIME_BUDGET. Service calls and queries time out at the latest when the
+    # budget runs out, candidates still pending then are cancelled and the best answer ranked so far is returned.
+    REQUEST_TIME_BUDGET = 30
+    REQUEST_MAX_TIME_BUDGET = 120
+
+    # Profiling of single /qa requests, for PROFILING_SAMPLE_RATE of them and, with PROFILING_ON_REQUEST, those
+    # sending the X-GeoQA-Profile header or profile parameter together with PROFILING_TOKEN in the
+    # X-GeoQA-Profile-Token header (no token, no profiling on request). PROFILING_MODE "cprofile" writes pstats,
+    # "sampling" collapsed stacks sampled every PROFILING_SAMPLE_INTERVAL seconds, both to PROFILING_OUTPUT_DIR, which
+    # keeps the latest PROFILING_MAX_DUMPS of them
+    PROFILING_SAMPLE_RATE = 0.0
+    PROFILING_ON_REQUEST = False
+    PROFILING_TOKEN = None
+    PROFILING_MODE = "sampling"
+    PROFILING_SAMPLE_INTERVAL = 0.005
+    PROFILING_OUTPUT_DIR = "profiles"
+    PROFILING_MAX_DUMPS = 100
+
+    # None, "record" or "replay". Recording captures every classifier, linker and SPARQL exchange with its latency
+    # in FIXTURE_PATH, replaying answers them in-process from that file without network I/O, waiting the recorded
+    # latency times FIXTURE_LATENCY_SCALE (0 answers immediately). Batched queries are recorded per candidate as well,
+    # and are not batched while replaying.
+    FIXTURE_MODE = None
+    FIXTURE_PATH = "fixtures.jsonl.gz"
+    FIXTURE_LATENCY_SCALE = 0.0
+
+    # QA44 benchmark (python -m geoqa.benchmark.runner): recorded service responses and the latency in seconds the
+    # stand-ins add per service, varied by +/- BENCHMARK_LATENCY_JITTER of it, drawn from a generator seeded with
+    # BENCHMARK_SEED
+    BENCHMARK_FIXTURE_PATH = "qa44_fixtures.jsonl.gz"
+    BENCHMARK_LATENCIES = {"classify": 0.05, "link": 0.2, "sparql": 0.05}
+    BENCHMARK_LATENCY_JITTER = 0.2
+    BENCHMARK_SEED = 0
+
     ABLATION_CLASSIFICATION = True
     ABLATION_LINKING = False
     ABLATION_RANKING = True
@@ -0,0 +1,58 @@
+from aiohttp import web
+
+from geoqa import app as flask_app
+from geoqa.service.orchestration import Orchestrator, AsyncOrchestrator
+from geoqa.util.cache_utils import CacheGeneration
+from geoqa.util.concurrency_utils import Deadline
+from geoqa.util.http_utils import AsyncHttpSessionProvider
+from geoqa.util.metrics_utils import MetricsRegistry
+from geoqa.views import get_qald_format_answer
+
+
+async def qa(request: web.Request):
+    CacheGeneration.refresh()
+    try:
+        if request.method == "POST":
+            params = await request.post()
+        else:
+            params = request.query
+        query = params.get('query')
+        lang = params.get('lang', 'en')
+        no_cache = params.get('no_cache', 'false')
+        deadline = Deadline.for_request(params.get('time_budget'))
+
+        flask_app.logger.info(f"{request.method} /qa {query}")
+
+        orchestration_service = AsyncOrchestrator()
+        answer = await orchestration_service.answer_question(query, lang, use_cache=no_cache.lower() != "true",
+                                                             deadline=deadline)
+        return web.json_response(get_qald_format_answer(answer))
+    except Exception as e:
+        flask_app.logger.error(f"Error: {str(e)}")
+        return web.json_response(Orchestrator.get_empty_answer())
+
+
+async def invalidate_cache(request: web.Request):
+    if not CacheGeneration.is_authorized(request.headers.get('X-GeoQA-Admin-Token'), request.remote):
+        return web.json_response({"error": "not authorized"}, status=403)
+    CacheGeneration.invalidate()
+    return web.json_response({"invalidated": True})
+
+
+async def metrics(request: web.Request):
+    return web.Response(text=MetricsRegistry.render(), content_type="text/plain")
+
+
+async def close_sessions(app: web.Application):
+    await AsyncHttpSessionProvider.close()
+
+
+def create_app() -> web.Application:
+    """aiohttp application serving /qa without blocking a thread per request, see run_async.py."""
+    app = web.Application()
+    app.add_routes([web.get("/qa", qa),
+                    web.post("/qa", qa),
+                    web.get("/metrics", metrics),
+                    web.post("/cache/invalidate", invalidate_cache)])
+    app.on_cleanup.append(close_sessions)
+    return app
@@ -0,0 +1,240 @@
+import argparse
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from geoqa import app as flask_app
+from geoqa.benchmark.stand_ins import StandInServer
+from geoqa.core.geometry_cache import GeometryMetadataCache, ProximityGridIndex
+from geoqa.core.query_executor import QueryExecutor
+from geoqa.core.query_generator import QueryGenerator
+from geoqa.service.orchestration import Orchestrator
+from geoqa.util.ablation_utils import AblationProvider
+from geoqa.util.fixture_utils import FixtureStore
+from geoqa.util.metrics_utils import STAGE_SECONDS, SPARQL_EXECUTE_SECONDS
+from geoqa.util.property_utils import PropertyUtils
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(values: List[float]) -> dict:
+    return {"count": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95),
+            "p99": percentile(values, 99)}
+
+
+class BenchmarkRunner(object):
+    """Replays the QA44 questions through the full pipeline against local stand-ins of the classifier, linker and
+    SPARQL endpoint serving recorded fixtures, see StandInServer. In-process, the fixtures are answered without any
+    HTTP, waiting their recorded latency times the latency scale, which leaves the pipeline's own CPU time to profile.
+
+    Every concurrency level starts from empty in-memory caches. For each level the report holds per-stage and
+    per-question latency percentiles, throughput and the accuracy against the QA44 golden answers.
+    """
+    LOG = flask_app.logger
+    # The persistent store would answer the services without reaching the fixtures, and the proximity grids are
+    # built from class-wide queries in the background that were never recorded
+    ISOLATED_CONFIG = {"SERVICE_CACHE_PATH": None, "PROXIMITY_INDEX_ENABLED": False}
+
+    def __init__(self, fixture_path: str, latency_scale: float = 1.0, in_process: bool = False, seed: int = None):
+        self.fixture_path = fixture_path
+        self.fixtures = FixtureStore(fixture_path)
+        self.latency_scale = latency_scale
+        self.in_process = in_process
+        self.seed = seed if seed is not None else flask_app.config['BENCHMARK_SEED']
+        self.golden_answers = AblationProvider.get_golden_answers()
+        self.questions = PropertyUtils.read_benchmark_questions()
+
+    @classmethod
+    def configure(cls, **overrides) -> dict:
+        """Applies the overrides to the config, returning the previous values to restore."""
+        previous = {key: flask_app.config.get(key) for key in overrides}
+        flask_app.config.update(overrides)
+        return previous
+
+    @classmethod
+    def use_stand_in(cls, server: StandInServer) -> dict:
+        host, port = server.server.host, str(server.server.port)
+        return cls.configure(
+            GEO_CLASSIFIER_SERVICE_SCHEME="http", GEO_CLASSIFIER_SERVICE_HOST=host,
+            GEO_CLASSIFIER_SERVICE_PORT=port, GEO_CLASSIFIER_SERVICE_ENDPOINT="classify",
+            LINKING_SERVICE_SCHEME="http", LINKING_SERVICE_HOST=host,
+            LINKING_SERVICE_PORT=port, LINKING_SERVICE_ENDPOINT="link",
+            SPARQL_ENDPOINT=f"{server.url}/sparql", SPARQL_EXECUTOR="remote", **cls.ISOLATED_CONFIG)
+
+    @classmethod
+    def reset_caches(cls):
+        QueryExecutor.invalidate_cache()
+        Orchestrator.invalidate_cache()
+        QueryGenerator.get_features_cache().clear()
+        GeometryMetadataCache.invalidate_cache()
+        ProximityGridIndex.invalidate_cache()
+
+    def record(self):
+        """Answers every question once against the real services, recording their responses."""
+        previous = self.configure(FIXTURE_MODE="record", FIXTURE_PATH=self.fixture_path, **self.ISOLATED_CONFIG)
+        try:
+            self.reset_caches()
+            for question in self.questions:
+                self.answer(question)
+            self.fixtures = FixtureStore.get_store()
+            self.fixtures.save()
+        finally:
+            flask_app.config.update(previous)
+
+    def run(self, concurrency_levels: List[int]) -> dict:
+        if self.in_process:
+            return self.run_in_process(concurrency_levels)
+        return self.run_with_stand_in(concurrency_levels)
+
+    def run_in_process(self, concurrency_levels: List[int]) -> dict:
+        previous = self.configure(FIXTURE_MODE="replay", FIXTURE_PATH=self.fixture_path,
+                                  FIXTURE_LATENCY_SCALE=self.latency_scale, **self.ISOLATED_CONFIG)
+        try:
+            store = FixtureStore.get_store()
+            report = {
+                "config": dict(self.get_report_config(), in_process=True, latency_scale=self.latency_scale),
+                "levels": {str(concurrency): self.run_level(concurrency) for concurrency in concurrency_levels},
+                "unrecorded_requests": store.misses
+            }
+        finally:
+            flask_app.config.update(previous)
+        return report
+
+    def run_with_stand_in(self, concurrency_levels: List[int]) -> dict:
+        latencies = {service: latency * self.latency_scale
+                     for service, latency in flask_app.config['BENCHMARK_LATENCIES'].items()}
+        server = StandInServer(self.fixtures, latencies, flask_app.config['BENCHMARK_LATENCY_JITTER'],
+                               self.seed).start()
+        previous = self.use_stand_in(server)
+        try:
+            report = {
+                "config": dict(self.get_report_config(), latencies=latencies,
+                               latency_jitter=flask_app.config['BENCHMARK_LATENCY_JITTER'], seed=self.seed),
+                "levels": {str(concurrency): self.run_level(concurrency) for concurrency in concurrency_levels},
+                "unrecorded_requests": dict(server.misses)
+            }
+        finally:
+            flask_app.config.update(previous)
+            server.stop()
+        return report
+
+    @classmethod
+    def get_report_config(cls) -> dict:
+        return {
+            "ablation_classification": flask_app.config['ABLATION_CLASSIFICATION'],
+            "ablation_linking": flask_app.config['ABLATION_LINKING'],
+            "ablation_ranking": flask_app.config['ABLATION_RANKING'],
+            "ranking_mode": flask_app.config['RANKING_MODE']
+        }
+
+    def run_level(self, concurrency: int) -> dict:
+        self.reset_caches()
+        STAGE_SECONDS.start_recording()
+        SPARQL_EXECUTE_SECONDS.start_recording()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            outcomes = list(pool.map(self.answer, self.questions))
+        elapsed = time.perf_counter() - start
+
+        stages = {key[0]: summarize(values) for key, values in STAGE_SECONDS.stop_recording().items()}
+        sparql = [value for values in SPARQL_EXECUTE_SECONDS.stop_recording().values() for value in values]
+        scores = [self.score(question, answer) for question, (answer, _) in zip(self.questions, outcomes)]
+
+        self.LOG.info(f"Benchmark at concurrency {concurrency} took {elapsed:.2f}s")
+        return {
+            "seconds": elapsed,
+            "throughput": len(self.questions) / elapsed,
+            "question": summarize([question_seconds for _, question_seconds in outcomes]),
+            "stages": stages,
+            "sparql_execute": summarize(sparql),
+            "accuracy": sum(1 for correct, _ in scores if correct) / len(scores),
+            "mean_f1": sum(f1 for _, f1 in scores) / len(scores),
+            "failed": sum(1 for answer, _ in outcomes if answer is None)
+        }
+
+    def answer(self, question: str):
+        start = time.perf_counter()
+        try:
+            answer = Orchestrator().answer_question(question)
+        except Exception as e:
+            self.LOG.error(f"Benchmark question failed: {question}: {str(e)}")
+            answer = None
+        return answer, time.perf_counter() - start
+
+    def score(self, question: str, answer: Optional[dict]):
+        """Whether the answer matches the golden answer, and the F1 of their answer strings."""
+        golden = self.golden_answers.get(question)
+        if golden is None or answer is None:
+            return False, 0.0
+
+        if golden['type'] == 'boolean':
+            correct = answer.get('boolean') == golden.get('value')
+            return correct, 1.0 if correct else 0.0
+
+        if 'results' not in answer or len(answer['head'].get('vars', [])) == 0:
+            return False, 0.0
+        expected = set(golden.get('value', []))
+        actual = set(AblationProvider.get_answer_strings(answer))
+        common = len(expected & actual)
+        f1 = 2 * common / (len(expected) + len(actual)) if len(expected) + len(actual) > 0 else 1.0
+        return expected == actual, f1
+
+
+def diff_reports(baseline: dict, current: dict) -> List[str]:
+    """Lines comparing the headline numbers of two reports, level by level."""
+    lines = []
+    for level, current_level in current["levels"].items():
+        baseline_level = baseline["levels"].get(level)
+        if baseline_level is None:
+            continue
+        rows = [("throughput", baseline_level["throughput"], current_level["throughput"]),
+                ("accuracy", baseline_level["accuracy"], current_level["accuracy"])]
+        for p in ("p50", "p95", "p99"):
+            rows.append((f"question {p}", baseline_level["question"][p], current_level["question"][p]))
+        for stage in sorted(current_level["stages"]):
+            if stage in baseline_level["stages"]:
+                rows.append((f"{stage} p95", baseline_level["stages"][stage]["p95"],
+                             current_level["stages"][stage]["p95"]))
+
+        lines.append(f"concurrency {level}")
+        for name, before, after in rows:
+            if before is None or after is None:
+                continue
+            change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+            lines.append(f"  {name:<40} {before:>10.4f} {after:>10.4f} {change:>9}")
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="QA44 benchmark against local service stand-ins")
+    parser.add_argument("--fixtures", default=flask_app.config['BENCHMARK_FIXTURE_PATH'])
+    parser.add_argument("--record", action="store_true", help="record responses of the real services first")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated concurrency levels")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="factor applied to the injected latencies")
+    parser.add_argument("--in-process", action="store_true",
+                        help="replay the fixtures without HTTP, e.g. with --latency-scale 0 for CPU profiling")
+    parser.add_argument("--seed", type=int, help="seed of the latency jitter, BENCHMARK_SEED by default")
+    parser.add_argument("--save", help="write the report to this file, e.g. as a baseline")
+    parser.add_argument("--baseline", help="report of an earlier run to compare against")
+    args = parser.parse_args()
+
+    runner = BenchmarkRunner(args.fixtures, args.latency_scale, args.in_process, args.seed)
+    if args.record:
+        runner.record()
+
+    result = runner.run([int(level) for level in args.concurrency.split(",")])
+    print(json.dumps(result, indent=2))
+    if args.save:
+        with open(args.save, "w") as report_file:
+            json.dump(result, report_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            print("\n".join(diff_reports(json.load(baseline_file), result)))
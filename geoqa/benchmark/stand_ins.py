@@ -0,0 +1,70 @@
+import random
+import threading
+import time
+
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Request, Response
+
+from geoqa import app as flask_app
+from geoqa.util.fixture_utils import FixtureStore
+
+SERVICES = ("classify", "link", "sparql")
+
+
+class StandInServer(object):
+    """Local HTTP server standing in for the classifier (/classify), linker (/link) and SPARQL endpoint (/sparql).
+
+    It serves the responses of a FixtureStore after an injected latency of latencies[service] seconds, varied by
+    +/- jitter of that value with a random generator seeded with seed, and answers 404 for unrecorded requests.
+    """
+    LOG = flask_app.logger
+
+    def __init__(self, fixtures: FixtureStore, latencies: dict = None, jitter: float = 0.0, seed: int = 0,
+                 host: str = "127.0.0.1", port: int = 0):
+        self.fixtures = fixtures
+        self.latencies = latencies or {}
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.misses = {service: 0 for service in SERVICES}
+        self.lock = threading.Lock()
+        self.server = make_server(host, port, self.handle, threaded=True)
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.server.host}:{self.server.port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.thread.join()
+
+    def handle(self, environ, start_response):
+        request = Request(environ)
+        service = request.path.strip("/")
+        if service not in SERVICES:
+            return Response("Unknown service", status=404)(environ, start_response)
+
+        response = self.replay(service, FixtureStore.get_key(service, request.form.to_dict()))
+        return response(environ, start_response)
+
+    def replay(self, service: str, key: str) -> Response:
+        latency = self.latencies.get(service, 0.0)
+        if latency > 0:
+            with self.lock:
+                factor = self.random.uniform(1 - self.jitter, 1 + self.jitter)
+            time.sleep(latency * factor)
+
+        with self.lock:
+            fixture = self.fixtures.fixtures.get((service, key))
+            if fixture is None:
+                self.misses[service] += 1
+        if fixture is None:
+            self.LOG.warning(f"No recorded {service} response for {key}")
+            return Response("Not recorded", status=404)
+        content_type = "application/sparql-results+json" if service == "sparql" else "application/json"
+        return Response(fixture[0], content_type=content_type)
@@ -0,0 +1,222 @@
+import math
+import re
+import threading
+from collections import defaultdict
+from typing import Optional, Set, Tuple
+
+from geoqa import app as flask_app
+from geoqa.core.local_executor import LocalGeoSparqlEngine, METRES_PER_DEGREE
+from geoqa.core.query_executor import QueryExecutor
+from geoqa.util.cache_utils import LRUCache, CacheGeneration
+from geoqa.util.concurrency_utils import WorkerPools, Deadline
+from geoqa.util.fixture_utils import FixtureStore
+from geoqa.util.metrics_utils import MetricsRegistry
+
+BoundingBox = Tuple[float, float, float, float]
+
+
+class GeometryMetadataCache(object):
+    """Bounding boxes (min x, min y, max x, max y) of linked entities, filled lazily from the knowledge base."""
+    LOG = flask_app.logger
+    _bboxes = None
+
+    COORDINATE_REGEX = re.compile(r"(-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)\s+(-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)")
+    CRS_REGEX = re.compile(r"^\s*<[^>]*>\s*")
+    GEOMETRY_QUERY = "PREFIX geo: <http://www.opengis.net/ont/geosparql#> " \
+                     "SELECT ?wkt WHERE { <__ENTITY__> geo:hasGeometry ?geom . ?geom geo:asWKT ?wkt }"
+
+    @classmethod
+    def get_cache(cls) -> LRUCache:
+        if cls._bboxes is None:
+            cls._bboxes = LRUCache(flask_app.config['BBOX_CACHE_SIZE'])
+        return cls._bboxes
+
+    @classmethod
+    def invalidate_cache(cls):
+        cls.get_cache().clear()
+        cls.LOG.info("Bounding box cache invalidated")
+
+    @classmethod
+    def get_bbox(cls, uri: str, deadline: Deadline = None) -> Optional[BoundingBox]:
+        """The bounding box of the entity, None if it has no geometry or it is not cached and the deadline expired."""
+        cache = cls.get_cache()
+        bbox = cache.get(uri)
+        if bbox is None:
+            if deadline is not None and deadline.is_expired():
+                return None
+            bbox, loaded = cls.load_bbox(uri, deadline)
+            # Entities without geometry are cached as False so they are not looked up again, failed lookups are not
+            # cached at all
+            if loaded:
+                cache.put(uri, bbox or False)
+
+        return bbox or None
+
+    @classmethod
+    def load_bbox(cls, uri: str, deadline: Deadline = None) -> Tuple[Optional[BoundingBox], bool]:
+        """The bounding box of the entity, None if it has no geometry, and whether the lookup succeeded. The query
+        times out at the latest when the deadline expires."""
+        if flask_app.config['SPARQL_EXECUTOR'] == "local":
+            engine = LocalGeoSparqlEngine.get_instance()
+            if engine is not None:
+                return cls.merge_bboxes([entry.geometry.bounds for entry in engine.geometries.get(uri, [])]), True
+
+        results = QueryExecutor.execute(cls.GEOMETRY_QUERY.replace("__ENTITY__", uri),
+                                        timeout=QueryExecutor.get_query_timeout(deadline))
+        if results is None:
+            return None, False
+        return cls.merge_bboxes([cls.parse_wkt_bbox(binding["wkt"]["value"])
+                                 for binding in results["results"]["bindings"]]), True
+
+    @classmethod
+    def parse_wkt_bbox(cls, wkt: str) -> Optional[BoundingBox]:
+        coordinates = [(float(x), float(y)) for x, y in cls.COORDINATE_REGEX.findall(cls.CRS_REGEX.sub("", wkt))]
+        if len(coordinates) == 0:
+            return None
+        xs = [c[0] for c in coordinates]
+        ys = [c[1] for c in coordinates]
+        return min(xs), min(ys), max(xs), max(ys)
+
+    @classmethod
+    def merge_bboxes(cls, bboxes) -> Optional[BoundingBox]:
+        bboxes = [bbox for bbox in bboxes if bbox is not None]
+        if len(bboxes) == 0:
+            return None
+        return min(b[0] for b in bboxes), min(b[1] for b in bboxes), max(b[2] for b in bboxes), \
+               max(b[3] for b in bboxes)
+
+    @classmethod
+    def expand_bbox(cls, bbox: BoundingBox, metres: float) -> BoundingBox:
+        delta_y = metres / METRES_PER_DEGREE
+        delta_x = delta_y / max(math.cos(math.radians((bbox[1] + bbox[3]) / 2)), 0.01)
+        return bbox[0] - delta_x, bbox[1] - delta_y, bbox[2] + delta_x, bbox[3] + delta_y
+
+    @classmethod
+    def to_wkt_literal(cls, bbox: BoundingBox) -> str:
+        min_x, min_y, max_x, max_y = bbox
+        return f'"POLYGON(({min_x} {min_y}, {max_x} {min_y}, {max_x} {max_y}, {min_x} {max_y}, {min_x} {min_y}))"' \
+               f'^^geo:wktLiteral'
+
+
+class ProximityGridIndex(object):
+    """Uniform grid over the geometries of one class, used to narrow proximity queries down to nearby targets.
+
+    Each target is registered in every cell its bounding box overlaps, so the targets found in the cells around an
+    anchor are a superset of those within the requested distance; the exact distance is still checked by the query.
+    Targets spanning more than MAX_CELLS_PER_TARGET cells are kept aside and always returned.
+
+    Grids are built in the background: until the grid of a class is ready, its proximity queries run unrestricted.
+    A failed build is not remembered, the next query of the class starts another one. While fixtures are recorded or
+    replayed no grids are used, so that the recorded query texts do not depend on build timing.
+    """
+    LOG = flask_app.logger
+    MAX_CELLS_PER_TARGET = 10000
+    _indexes = None
+    _building = set()
+    _lock = threading.Lock()
+
+    CLASS_GEOMETRIES_QUERY = "PREFIX geo: <http://www.opengis.net/ont/geosparql#> " \
+                             "SELECT ?target ?wkt WHERE { ?target a <__CLASS__> ; geo:hasGeometry ?geom . " \
+                             "?geom geo:asWKT ?wkt }"
+
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self.cells = defaultdict(set)
+        self.oversized = set()
+
+    @classmethod
+    def get_cache(cls) -> LRUCache:
+        with cls._lock:
+            if cls._indexes is None:
+                cls._indexes = LRUCache(flask_app.config['PROXIMITY_INDEX_CLASSES'],
+                                        flask_app.config['PROXIMITY_INDEX_TTL'])
+            return cls._indexes
+
+    @classmethod
+    def invalidate_cache(cls):
+        cls.get_cache().clear()
+        cls.LOG.info("Proximity grid cache invalidated")
+
+    @classmethod
+    def get_index(cls, class_uri: str) -> Optional["ProximityGridIndex"]:
+        """The grid of the class if it is built, otherwise None, starting a background build."""
+        if FixtureStore.get_mode() is not None:
+            return None
+
+        index = cls.get_cache().get(class_uri)
+        if index is None:
+            with cls._lock:
+                if class_uri in cls._building:
+                    return None
+                cls._building.add(class_uri)
+            WorkerPools.get_pool("proximity_index", 1).submit(cls.build_in_background, class_uri)
+
+        return index
+
+    @classmethod
+    def build_in_background(cls, class_uri: str):
+        try:
+            index = cls.build(class_uri)
+            if index is not None:
+                cls.get_cache().put(class_uri, index)
+        except Exception as e:
+            cls.LOG.error(f"Failed to build the proximity grid for {class_uri}: {str(e)}")
+        finally:
+            with cls._lock:
+                cls._building.discard(class_uri)
+
+    @classmethod
+    def build(cls, class_uri: str) -> Optional["ProximityGridIndex"]:
+        engine = LocalGeoSparqlEngine.get_instance() if flask_app.config['SPARQL_EXECUTOR'] == "local" else None
+        if engine is not None:
+            _, entries = engine.get_class_index(class_uri)
+            targets = [(entry.feature, entry.geometry.bounds) for entry in entries]
+        else:
+            # All geometries of a class are too large a result to keep in the SPARQL result cache
+            results = QueryExecutor.execute(cls.CLASS_GEOMETRIES_QUERY.replace("__CLASS__", class_uri),
+                                            use_cache=False)
+            if results is None:
+                return None
+            targets = [(binding["target"]["value"], GeometryMetadataCache.parse_wkt_bbox(binding["wkt"]["value"]))
+                       for binding in results["results"]["bindings"]]
+
+        index = ProximityGridIndex(flask_app.config['PROXIMITY_GRID_CELL_METRES'] / METRES_PER_DEGREE)
+        for target, bbox in targets:
+            if bbox is not None:
+                index.add(target, bbox)
+
+        cls.LOG.info(f"Built proximity grid for {class_uri} with {len(targets)} geometries")
+        return index
+
+    def get_cell_range(self, bbox: BoundingBox):
+        return range(math.floor(bbox[0] / self.cell_size), math.floor(bbox[2] / self.cell_size) + 1), \
+               range(math.floor(bbox[1] / self.cell_size), math.floor(bbox[3] / self.cell_size) + 1)
+
+    def add(self, target: str, bbox: BoundingBox):
+        x_range, y_range = self.get_cell_range(bbox)
+        if len(x_range) * len(y_range) > self.MAX_CELLS_PER_TARGET:
+            self.oversized.add(target)
+            return
+
+        for x in x_range:
+            for y in y_range:
+                self.cells[(x, y)].add(target)
+
+    def get_candidates(self, anchor_bbox: BoundingBox, distance: float) -> Optional[Set[str]]:
+        """Targets possibly within distance metres of the anchor, None if the search area is too large to scan."""
+        x_range, y_range = self.get_cell_range(GeometryMetadataCache.expand_bbox(anchor_bbox, distance))
+        if len(x_range) * len(y_range) > self.MAX_CELLS_PER_TARGET:
+            return None
+
+        candidates = set(self.oversized)
+        for x in x_range:
+            for y in y_range:
+                candidates.update(self.cells.get((x, y), ()))
+
+        return candidates
+
+
+MetricsRegistry.register_cache("bbox", GeometryMetadataCache.get_cache)
+MetricsRegistry.register_cache("proximity_grid", ProximityGridIndex.get_cache)
+CacheGeneration.register(GeometryMetadataCache.invalidate_cache)
+CacheGeneration.register(ProximityGridIndex.invalidate_cache)
@@ -0,0 +1,323 @@
+import math
+import re
+import threading
+from collections import defaultdict
+from typing import List, Optional
+
+import shapely.wkt
+from rdflib import Graph, Literal, URIRef
+from rdflib.namespace import RDF
+from shapely import affinity
+from shapely.geometry import box
+from shapely.strtree import STRtree
+
+from geoqa import app as flask_app
+
+GEO_HAS_GEOMETRY = URIRef("http://www.opengis.net/ont/geosparql#hasGeometry")
+GEO_AS_WKT = URIRef("http://www.opengis.net/ont/geosparql#asWKT")
+XSD_INTEGER = "http://www.w3.org/2001/XMLSchema#integer"
+
+METRES_PER_DEGREE = 111320.0
+
+
+class GeometryEntry(object):
+    def __init__(self, feature: str, wkt: str, geometry):
+        self.feature = feature
+        self.wkt = wkt
+        self.geometry = geometry
+
+
+class LocalGeoSparqlEngine(object):
+    """In-memory executor for the query shapes produced from query_templates.yml.
+
+    The knowledge base dump is loaded once; every geo:asWKT geometry is kept as a shapely geometry and the
+    geometries of each class are packed into an STR R-tree on first use. Spatial joins probe the R-tree with the
+    envelope of the anchor geometry and only evaluate the exact predicate for the index hits.
+    """
+    LOG = flask_app.logger
+    _instance = None
+    _load_failed = False
+    _lock = threading.Lock()
+
+    SPATIAL_FUNCTION_REGEX = re.compile(r"geof:(sfContains|sfTouches|sfCrosses)\((\?\w+),\s*(\?\w+)\)")
+    MATERIALIZED_RELATION_REGEX = re.compile(
+        r"(<[^>]+>|\?\w+)\s+geo:(sfContains|sfTouches|sfCrosses)\s+(<[^>]+>|\?\w+)")
+    DISTANCE_FUNCTION_REGEX = re.compile(r"geof:distance\((\?\w+),\s*(\?\w+),\s*uom:metre\)")
+    DISTANCE_FILTER_REGEX = re.compile(r"\?distance\s*<\s*([-\d.eE]+)")
+    HAS_GEOMETRY_REGEX = re.compile(r"(<[^>]+>|\?\w+)\s+(?:a\s+<[^>]+>\s*;\s*)?geo:hasGeometry\s+(\?\w+)")
+    AS_WKT_REGEX = re.compile(r"(\?\w+)\s+geo:asWKT\s+(\?\w+)")
+    TYPE_REGEX = re.compile(r"(\?\w+)\s+a\s+<([^>]+)>")
+    RELATION_REGEX = re.compile(r"(\?\w+)\s+<([^>]+)>\s+\?valueRaw")
+    RELATION_FILTER_REGEX = re.compile(r"FILTER\s*\(\s*\?value\s*([<>])\s*([-\d.eE]+)\s*\)")
+    ORDER_REGEX = re.compile(r"ORDER BY (ASC|DESC)\(\?value\)")
+    LIMIT_REGEX = re.compile(r"LIMIT (\d+)")
+    COUNT_REGEX = re.compile(r"COUNT\(DISTINCT (\?\w+)\)\s+as\s+(\?\w+)", re.IGNORECASE)
+    SELECT_REGEX = re.compile(r"SELECT\s+(\?\w+)\s+WHERE")
+    CRS_REGEX = re.compile(r"^\s*<[^>]*>\s*")
+
+    def __init__(self, dump_path: str):
+        self.geometries = defaultdict(list)
+        self.instances = defaultdict(set)
+        self.literals = defaultdict(lambda: defaultdict(list))
+        self._class_indexes = {}
+        self._index_lock = threading.Lock()
+        self.load(dump_path)
+
+    @classmethod
+    def get_instance(cls) -> Optional["LocalGeoSparqlEngine"]:
+        """The process wide engine, None if the dump could not be loaded. A failed load is not retried, so that
+        queries do not each parse the dump again."""
+        with cls._lock:
+            if cls._instance is None and not cls._load_failed:
+                try:
+                    cls._instance = LocalGeoSparqlEngine(flask_app.config['LOCAL_KB_DUMP_PATH'])
+                except Exception as e:
+                    cls.LOG.error(f"Failed to load the knowledge base dump {flask_app.config['LOCAL_KB_DUMP_PATH']}")
+                    cls.LOG.error(f"Error: {str(e)}")
+                    cls._load_failed = True
+            return cls._instance
+
+    def load(self, dump_path: str):
+        self.LOG.info(f"Loading knowledge base dump {dump_path}")
+        graph = Graph()
+        graph.parse(dump_path)
+
+        wkt_by_geometry = {}
+        for geometry_node, wkt in graph.subject_objects(GEO_AS_WKT):
+            wkt_by_geometry[geometry_node] = str(wkt)
+
+        for feature, geometry_node in graph.subject_objects(GEO_HAS_GEOMETRY):
+            wkt = wkt_by_geometry.get(geometry_node)
+            if wkt is None:
+                continue
+            try:
+                geometry = shapely.wkt.loads(self.CRS_REGEX.sub("", wkt))
+            except Exception as e:
+                self.LOG.error(f"Skipping invalid geometry of {feature}: {str(e)}")
+                continue
+            self.geometries[str(feature)].append(GeometryEntry(str(feature), wkt, geometry))
+
+        for subject, predicate, obj in graph:
+            if predicate == RDF.type:
+                self.instances[str(obj)].add(str(subject))
+            elif isinstance(obj, Literal) and predicate != GEO_AS_WKT:
+                self.literals[str(predicate)][str(subject)].append(str(obj))
+
+        self.LOG.info(f"Loaded {len(self.geometries)} features with geometries")
+
+    def get_class_index(self, class_uri: str):
+        with self._index_lock:
+            if class_uri not in self._class_indexes:
+                entries = [entry for feature in self.instances.get(class_uri, ())
+                           for entry in self.geometries.get(feature, ())]
+                tree = STRtree([entry.geometry for entry in entries]) if len(entries) > 0 else None
+                self._class_indexes[class_uri] = (tree, entries)
+
+            return self._class_indexes[class_uri]
+
+    def execute(self, query: str) -> Optional[dict]:
+        """Returns SPARQL JSON results for a supported query shape, or None if the shape is not supported."""
+        plan = self.parse_query(query)
+        if plan is None:
+            return None
+
+        rows = self.evaluate(plan)
+
+        if plan["form"] == "ASK":
+            return {"head": {}, "boolean": len(rows) > 0}
+
+        if plan["count"] is not None:
+            counted_variable, count_variable = plan["count"]
+            count = len(set(row.get(counted_variable) for row in rows if counted_variable in row))
+            return {"head": {"vars": [count_variable[1:]]},
+                    "results": {"bindings": [
+                        {count_variable[1:]: {"type": "literal", "datatype": XSD_INTEGER, "value": str(count)}}]}}
+
+        variable = plan["variable"]
+        return {"head": {"vars": [variable[1:]]},
+                "results": {"bindings": [{variable[1:]: {"type": "uri", "value": row[variable]}}
+                                         for row in rows if variable in row]}}
+
+    def parse_query(self, query: str) -> Optional[dict]:
+        form_match = re.search(r"\b(SELECT|ASK)\b", query)
+        if form_match is None:
+            return None
+
+        plan = {"form": form_match.group(1), "count": None, "variable": None, "spatial": None, "distance": None,
+                "classes": {}, "relation": None, "relation_filter": None, "order": None, "limit": None,
+                "exclude_same": "sameTerm(" in query}
+
+        count_match = self.COUNT_REGEX.search(query)
+        if count_match is not None:
+            plan["count"] = (count_match.group(1), count_match.group(2))
+        elif plan["form"] == "SELECT":
+            select_match = self.SELECT_REGEX.search(query)
+            if select_match is None:
+                return None
+            plan["variable"] = select_match.group(1)
+
+        feature_by_geometry = {term_geometry[1]: term_geometry[0]
+                               for term_geometry in self.HAS_GEOMETRY_REGEX.findall(query)}
+        feature_by_wkt = {wkt: feature_by_geometry.get(geometry) for geometry, wkt in self.AS_WKT_REGEX.findall(query)}
+        plan["classes"] = dict(self.TYPE_REGEX.findall(query))
+
+        spatial_match = self.SPATIAL_FUNCTION_REGEX.search(query)
+        distance_match = self.DISTANCE_FUNCTION_REGEX.search(query)
+        materialized_match = self.MATERIALIZED_RELATION_REGEX.search(query)
+        if materialized_match is not None:
+            # Lookup of a precomputed relation, which never relates a geometry to itself
+            left_term, function, right_term = materialized_match.groups()
+            plan["spatial"] = (function, left_term, right_term)
+            plan["exclude_same"] = True
+        elif spatial_match is not None:
+            function, left_wkt, right_wkt = spatial_match.groups()
+            plan["spatial"] = (function, feature_by_wkt.get(left_wkt), feature_by_wkt.get(right_wkt))
+        elif distance_match is not None:
+            distance_filter = self.DISTANCE_FILTER_REGEX.search(query)
+            if distance_filter is None:
+                return None
+            left_wkt, right_wkt = distance_match.groups()
+            plan["spatial"] = ("distance", feature_by_wkt.get(left_wkt), feature_by_wkt.get(right_wkt))
+            plan["distance"] = float(distance_filter.group(1))
+        elif "geof:" in query:
+            return None
+
+        if plan["spatial"] is not None and (plan["spatial"][1] is None or plan["spatial"][2] is None):
+            return None
+
+        relation_match = self.RELATION_REGEX.search(query)
+        if relation_match is not None:
+            plan["relation"] = relation_match.groups()
+            relation_filter = self.RELATION_FILTER_REGEX.search(query)
+            if relation_filter is not None:
+                plan["relation_filter"] = (relation_filter.group(1), float(relation_filter.group(2)))
+
+        order_match = self.ORDER_REGEX.search(query)
+        if order_match is not None:
+            plan["order"] = order_match.group(1)
+        limit_match = self.LIMIT_REGEX.search(query)
+        if limit_match is not None:
+            plan["limit"] = int(limit_match.group(1))
+
+        return plan
+
+    def evaluate(self, plan: dict) -> List[dict]:
+        if plan["spatial"] is not None:
+            rows = self.evaluate_spatial(plan)
+        else:
+            variable = plan["count"][0] if plan["count"] is not None else plan["variable"]
+            if variable is None and len(plan["classes"]) == 1:
+                variable = next(iter(plan["classes"]))
+            if variable not in plan["classes"]:
+                return []
+            _, entries = self.get_class_index(plan["classes"][variable])
+            rows = [{variable: entry.feature} for entry in entries]
+
+        if plan["relation"] is not None:
+            rows = self.apply_relation(plan, rows)
+
+        if plan["limit"] is not None:
+            rows = rows[:plan["limit"]]
+
+        return rows
+
+    def get_entries(self, term: str, plan: dict):
+        """Returns the geometry entries a feature term can bind to and, for class variables, their R-tree."""
+        if term.startswith("<"):
+            return None, self.geometries.get(term[1:-1], [])
+
+        class_uri = plan["classes"].get(term)
+        if class_uri is None:
+            return None, []
+        return self.get_class_index(class_uri)
+
+    def evaluate_spatial(self, plan: dict) -> List[dict]:
+        function, left_term, right_term = plan["spatial"]
+        left_tree, left_entries = self.get_entries(left_term, plan)
+        right_tree, right_entries = self.get_entries(right_term, plan)
+
+        # Probe the indexed side with the geometries of the other one, preferring to iterate the smaller side
+        probe_right = right_tree is not None and (left_tree is None or len(left_entries) <= len(right_entries))
+        if probe_right:
+            probe_entries, indexed_tree, indexed_entries = left_entries, right_tree, right_entries
+        elif left_tree is not None:
+            probe_entries, indexed_tree, indexed_entries = right_entries, left_tree, left_entries
+        else:
+            probe_entries, indexed_tree, indexed_entries = left_entries, None, right_entries
+
+        rows = []
+        for probe in probe_entries:
+            if indexed_tree is not None:
+                candidates = [indexed_entries[i] for i in indexed_tree.query(self.get_search_window(probe, plan))]
+            else:
+                candidates = indexed_entries
+
+            for candidate in candidates:
+                left, right = (probe, candidate) if probe_right or indexed_tree is None else (candidate, probe)
+                if plan["exclude_same"] and left.wkt == right.wkt:
+                    continue
+                if self.holds(function, left.geometry, right.geometry, plan["distance"]):
+                    row = {}
+                    if left_term.startswith("?"):
+                        row[left_term] = left.feature
+                    if right_term.startswith("?"):
+                        row[right_term] = right.feature
+                    rows.append(row)
+
+        return rows
+
+    @classmethod
+    def get_search_window(cls, entry: GeometryEntry, plan: dict):
+        min_x, min_y, max_x, max_y = entry.geometry.bounds
+        if plan["distance"] is None:
+            return box(min_x, min_y, max_x, max_y)
+
+        delta_y = plan["distance"] / METRES_PER_DEGREE
+        delta_x = delta_y / max(math.cos(math.radians((min_y + max_y) / 2)), 0.01)
+        return box(min_x - delta_x, min_y - delta_y, max_x + delta_x, max_y + delta_y)
+
+    @classmethod
+    def holds(cls, function: str, left, right, distance: float = None) -> bool:
+        if function == "sfContains":
+            return left.contains(right)
+        elif function == "sfTouches":
+            return left.touches(right)
+        elif function == "sfCrosses":
+            return left.crosses(right)
+        else:
+            return cls.metric_distance(left, right) < distance
+
+    @classmethod
+    def metric_distance(cls, left, right) -> float:
+        # Equirectangular projection around the left geometry, accurate enough at city scale
+        x_factor = METRES_PER_DEGREE * math.cos(math.radians(left.centroid.y))
+        return affinity.scale(left, x_factor, METRES_PER_DEGREE, origin=(0, 0)).distance(
+            affinity.scale(right, x_factor, METRES_PER_DEGREE, origin=(0, 0)))
+
+    def apply_relation(self, plan: dict, rows: List[dict]) -> List[dict]:
+        variable, predicate = plan["relation"]
+        values_by_subject = self.literals.get(predicate, {})
+
+        related_rows = []
+        for row in rows:
+            for raw_value in values_by_subject.get(row.get(variable), ()):
+                # Mirrors BIND(xsd:float(REPLACE(xsd:string(?valueRaw), "[^\\d\\.,]", "")) AS ?value)
+                try:
+                    value = float(re.sub(r"[^\d.,]", "", raw_value))
+                except ValueError:
+                    value = None
+
+                if plan["relation_filter"] is not None:
+                    operator, threshold = plan["relation_filter"]
+                    if value is None or (value <= threshold if operator == ">" else value >= threshold):
+                        continue
+
+                related_row = dict(row)
+                related_row["?value"] = value
+                related_rows.append(related_row)
+
+        if plan["order"] is not None:
+            related_rows.sort(key=lambda r: (r["?value"] is not None, r["?value"] or 0.0),
+                              reverse=plan["order"] == "DESC")
+
+        return related_rows
@@ -1,76 +1,504 @@
-from typing import List
-
-from SPARQLWrapper import SPARQLWrapper, JSON
+import asyncio
+import json
+import math
+import re
+import time
+from concurrent.futures import as_completed, wait, TimeoutError
+from typing import List, Optional, Tuple
 
 from geoqa import app as flask_app
+from geoqa.core.local_executor import LocalGeoSparqlEngine
 from geoqa.model.beans import FilledQuery, Constants, QueryAndResult
+from geoqa.util.cache_utils import LRUCache, CacheGeneration
+from geoqa.util.concurrency_utils import WorkerPools, Deadline
+from geoqa.util.fixture_utils import FixtureStore
+from geoqa.util.http_utils import HttpSessionProvider, AsyncHttpSessionProvider
+from geoqa.util.metrics_utils import MetricsRegistry, Span, STAGE_SECONDS, SPARQL_EXECUTE_SECONDS, \
+    CANDIDATES_GENERATED, CANDIDATES_FILTERED, EMPTY_RESULTS
 
 
 class QueryExecutor(object):
     LOG = flask_app.logger
+    _result_cache = None
+
+    @classmethod
+    def get_result_cache(cls) -> LRUCache:
+        if cls._result_cache is None:
+            cls._result_cache = LRUCache(flask_app.config['SPARQL_CACHE_SIZE'], flask_app.config['SPARQL_CACHE_TTL'])
+        return cls._result_cache
+
+    @classmethod
+    def invalidate_cache(cls):
+        """Drops all cached query results, to be called whenever the knowledge base behind the endpoint changes."""
+        cls.get_result_cache().clear()
+        cls.LOG.info("SPARQL result cache invalidated")
 
     @classmethod
-    def execute(cls, query, sparql_endpoint=None):
+    def normalize_query(cls, query: str) -> str:
+        return re.sub(r"\s+", " ", query.strip())
+
+    @classmethod
+    def get_cache_key(cls, query: str, sparql_endpoint=None) -> tuple:
         if sparql_endpoint is None:
-            sparql_endpoint = flask_app.config['SPARQL_ENDPOINT']
+            use_local_executor = flask_app.config['SPARQL_EXECUTOR'] == "local"
+            sparql_endpoint = "local" if use_local_executor else flask_app.config['SPARQL_ENDPOINT']
+        return sparql_endpoint, cls.normalize_query(query)
+
+    @classmethod
+    def execute(cls, query, sparql_endpoint=None, timeout=None, use_cache=True):
+        start = time.perf_counter()
+        results, source = cls.execute_timed(query, sparql_endpoint, timeout, use_cache)
+        MetricsRegistry.observe(SPARQL_EXECUTE_SECONDS, time.perf_counter() - start, source=source)
+        return results
+
+    @classmethod
+    def execute_timed(cls, query, sparql_endpoint=None, timeout=None,
+                      use_cache=True) -> Tuple[Optional[dict], str]:
+        """Results of the query and where they came from: cache, fixture, local, remote or failed. Without use_cache
+        the result cache is neither read nor written."""
+        cache, cache_key, sparql_endpoint, timeout, use_local_executor = \
+            cls.get_execution_target(query, sparql_endpoint, timeout, use_cache)
+
+        answered = cls.answer_without_execution(query, cache, cache_key)
+        if answered is not None:
+            results, source, delay = answered
+            if delay > 0:
+                time.sleep(delay)
+            return results, source
+
+        start = time.perf_counter()
+        if use_local_executor:
+            answered = cls.finish_local_execution(query, cls.execute_locally(query), cache, cache_key, start)
+            if answered is not None:
+                return answered
 
         try:
-            sparql = SPARQLWrapper(sparql_endpoint, returnFormat=JSON)
-            sparql.setQuery(query)
-            results = sparql.query().convert()
-            return results
+            response = HttpSessionProvider.get_session().post(
+                sparql_endpoint, data={"query": query}, headers={"Accept": "application/sparql-results+json"},
+                timeout=HttpSessionProvider.get_timeout(timeout))
+            response.raise_for_status()
+            return cls.store_results(query, response.json(), response.text, cache, cache_key, start), "remote"
         except Exception as e:
             cls.LOG.error(f"Query execution failed: {query}")
             cls.LOG.error(f"Error: {str(e)}")
+            return None, "failed"
 
-    def execute_and_rank(self, queries: List[FilledQuery]):
-        results = []
-        if len(queries) > 0:
-            # print(queries[0].question)
-            # print("before: ", len(queries))
-            queries = self.pre_execution_filter(queries)
-            # print("after: ", len(queries))
+    @classmethod
+    def get_execution_target(cls, query: str, sparql_endpoint=None, timeout=None,
+                             use_cache=True) -> Tuple[LRUCache, tuple, str, float, bool]:
+        """Result cache, cache key, endpoint, timeout and whether the local executor answers, shared by the sync and
+        async execution."""
+        use_local_executor = sparql_endpoint is None and flask_app.config['SPARQL_EXECUTOR'] == "local"
+        # A cache of size 0 never holds anything
+        cache = cls.get_result_cache() if use_cache else LRUCache(0)
+        cache_key = cls.get_cache_key(query, sparql_endpoint)
+        if sparql_endpoint is None:
+            sparql_endpoint = flask_app.config['SPARQL_ENDPOINT']
+        if timeout is None:
+            timeout = flask_app.config['QUERY_EXECUTION_TIMEOUT']
+        return cache, cache_key, sparql_endpoint, timeout, use_local_executor
+
+    @classmethod
+    def answer_without_execution(cls, query: str, cache: LRUCache,
+                                 cache_key: tuple) -> Optional[Tuple[Optional[dict], str, float]]:
+        """Results, source and the seconds to wait before returning them, if the query is answered from the cache or,
+        while replaying, from the fixtures. None if it has to be executed."""
+        results = cache.get(cache_key)
+        if results is not None:
+            return results, "cache", 0.0
+
+        if FixtureStore.is_replaying():
+            fixture = cls.get_fixture(query)
+            if fixture is None:
+                return None, "failed", 0.0
+            cache.put(cache_key, fixture[0])
+            return fixture[0], "fixture", fixture[1]
+
+        return None
+
+    @classmethod
+    def finish_local_execution(cls, query: str, results: Optional[dict], cache: LRUCache, cache_key: tuple,
+                               start: float) -> Optional[Tuple[Optional[dict], str]]:
+        """Results and source of a local execution, None if the query is to be sent to the endpoint instead."""
+        if results is not None:
+            return cls.store_results(query, results, json.dumps(results), cache, cache_key, start), "local"
+        if not flask_app.config['LOCAL_EXECUTOR_REMOTE_FALLBACK']:
+            cls.LOG.error(f"Query not answered by the local executor: {query}")
+            return None, "failed"
+        return None
+
+    @classmethod
+    def store_results(cls, query: str, results: dict, response: str, cache: LRUCache, cache_key: tuple,
+                      start: float) -> dict:
+        cache.put(cache_key, results)
+        cls.record_fixture(query, response, start)
+        return results
+
+    @classmethod
+    def execute_locally(cls, query: str) -> Optional[dict]:
+        """Results of the local executor, None if its knowledge base is unavailable, it does not support the query
+        shape or evaluation failed."""
+        engine = LocalGeoSparqlEngine.get_instance()
+        if engine is None:
+            return None
+        try:
+            return engine.execute(query)
+        except Exception as e:
+            cls.LOG.error(f"Local query execution failed: {query}")
+            cls.LOG.error(f"Error: {str(e)}")
+            return None
+
+    @classmethod
+    def get_fixture(cls, query: str) -> Optional[Tuple[dict, float]]:
+        """Recorded results of the query and the seconds to wait before returning them, see FixtureStore."""
+        fixture = FixtureStore.get_store().lookup("sparql", FixtureStore.get_key("sparql", {"query": query}))
+        if fixture is None:
+            return None
+        return json.loads(fixture[0]), FixtureStore.get_replay_delay(fixture[1])
 
-            # Execution
+    @classmethod
+    def record_fixture(cls, query: str, response: str, start: float):
+        if FixtureStore.is_recording():
+            FixtureStore.get_store().record("sparql", FixtureStore.get_key("sparql", {"query": query}), response,
+                                            time.perf_counter() - start)
+
+    @classmethod
+    def get_query_timeout(cls, deadline: Deadline = None):
+        """QUERY_EXECUTION_TIMEOUT cut to the remaining request budget."""
+        if deadline is None:
+            return None
+        return deadline.get_timeout(flask_app.config['QUERY_EXECUTION_TIMEOUT'])
+
+    def execute_and_rank(self, queries: List[FilledQuery], deadline: Deadline = None):
+        """Ranked results of the candidates. Candidates still pending when the deadline expires are cancelled and
+        left out of the ranking."""
+        if len(queries) == 0:
+            return []
+
+        queries = self.prepare(queries)
+
+        # Golden answer ablation picks among all results, so it always needs every candidate executed
+        if flask_app.config['RANKING_MODE'] == "early_termination" and not flask_app.config['ABLATION_RANKING']:
+            return self.execute_and_rank_early_termination(queries, deadline)
+
+        return self.rank(queries, self.execute_queries(queries, deadline))
+
+    def execute_and_rank_all(self, query_lists: List[List[FilledQuery]],
+                             deadline: Deadline = None) -> List[List[QueryAndResult]]:
+        """Ranks the candidates of several questions at once, executing every distinct query text only once across
+        all of them. All candidates are executed, regardless of RANKING_MODE."""
+        prepared = [self.prepare(queries) if len(queries) > 0 else [] for queries in query_lists]
+
+        unique = {}
+        for queries in prepared:
             for query in queries:
-                query_and_result = self.execute(query.query)
-                empty_result = False
-                if query.is_select_query() and len(query_and_result['results']['bindings']) == 0:
-                    empty_result = True
-                if not empty_result:
-                    results.append(QueryAndResult(query, query_and_result))
+                unique.setdefault(self.normalize_query(query.query), query)
+        if sum(len(queries) for queries in prepared) > len(unique):
+            self.LOG.info(f"Sharing {len(unique)} distinct queries across {len(query_lists)} questions")
+
+        results = dict(zip(unique.keys(), self.execute_queries(list(unique.values()), deadline)))
+        return [self.rank(queries, [results[self.normalize_query(query.query)] for query in queries])
+                for queries in prepared]
+
+    def execute_and_rank_incrementally(self, queries: List[FilledQuery], deadline: Deadline = None):
+        """Yields (False, ranking so far) each time a batch of candidates completes, then (True, complete ranking).
+        Scores and tie-breaking are those of the exhaustive mode, so the complete ranking equals what
+        execute_and_rank returns with RANKING_MODE "exhaustive"; every candidate is executed, unless the deadline
+        expires first, in which case the final ranking is the one so far."""
+        deadline = deadline or Deadline()
+        queries = self.prepare(queries) if len(queries) > 0 else []
+        batches = self.plan_execution_units(queries)
+        pool = WorkerPools.get_pool("sparql", flask_app.config['QUERY_EXECUTION_WORKERS'])
+        futures = {pool.submit(self.execute_batch, [queries[i] for i in batch], deadline): batch
+                   for batch in batches}
+
+        ranked = []
+        try:
+            for future in as_completed(futures, timeout=deadline.remaining()):
+                for i, result in zip(futures[future], future.result()):
+                    if self.is_answer(queries[i], result):
+                        score = self.get_pre_execution_score(queries[i]) + self.get_result_score(queries[i], result)
+                        ranked.append((score, i, QueryAndResult(queries[i], result, score)))
+
+                ranked.sort(key=lambda r: (-r[0], r[1]))
+                yield False, [query_and_result for _, _, query_and_result in ranked]
+        except TimeoutError:
+            self.LOG.warning(f"Request deadline expired with {sum(1 for f in futures if not f.done())} of "
+                             f"{len(futures)} query executions pending")
+        finally:
+            # Candidates not started yet are dropped when the consumer stops early, e.g. on a client disconnect
+            for future in futures:
+                future.cancel()
+
+        yield True, [query_and_result for _, _, query_and_result in ranked]
+
+    @classmethod
+    def prepare(cls, queries: List[FilledQuery]) -> List[FilledQuery]:
+        filtered = cls.pre_execution_filter(queries)
+        deduplicated = cls.deduplicate(filtered)
+        MetricsRegistry.inc(CANDIDATES_GENERATED, len(queries))
+        MetricsRegistry.inc(CANDIDATES_FILTERED, len(queries) - len(filtered), reason="pre_execution_filter")
+        MetricsRegistry.inc(CANDIDATES_FILTERED, len(filtered) - len(deduplicated), reason="duplicate")
+        return deduplicated
 
-            # Ranking
-            for query_and_result in results:
-                all_links = query_and_result.query.get_all_links()
+    @classmethod
+    def rank(cls, queries: List[FilledQuery], query_results: List[Optional[dict]]) -> List[QueryAndResult]:
+        with Span(STAGE_SECONDS, stage="ranking"):
+            return cls.rank_results(queries, query_results)
 
-                # add multiplier value of linked candidates, i.e., queries using exact matches rank higher
-                score = query_and_result.ranking_score + sum([link.multiplier for link in all_links])
+    @classmethod
+    def rank_results(cls, queries: List[FilledQuery], query_results: List[Optional[dict]]) -> List[QueryAndResult]:
+        results = []
+        # Execution
+        for query, query_and_result in zip(queries, query_results):
+            if cls.is_answer(query, query_and_result):
+                results.append(QueryAndResult(query, query_and_result))
 
-                # add length of search term of linked candidates, i.e., queries using longer matches phrases rank higher
-                score = score + sum([len(link.originalTerm) for link in all_links])
+        # Ranking
+        for query_and_result in results:
+            query_and_result.ranking_score = query_and_result.ranking_score + \
+                                             cls.get_pre_execution_score(query_and_result.query) + \
+                                             cls.get_result_score(query_and_result.query, query_and_result.result)
 
-                # add number of results returned, i.e., queries returning more number results rank higher
-                if query_and_result.query.is_select_query():
-                    score = score + len(query_and_result.result["results"]["bindings"])
-                    # pass # disabling the rule
-                else:  # if ASK query and answer is True, rank higher
-                    if query_and_result.result["boolean"]:
-                        score = score + 1
+        return sorted(results, key=lambda q_and_r: -q_and_r.ranking_score)
 
-                # TODO for Proximity questions, rank relation > way > node
-                # if query_and_result.query.geo_operator == Constants.GEO_OPERATOR_PROXIMITY:
+    def execute_and_rank_early_termination(self, queries: List[FilledQuery],
+                                           deadline: Deadline = None) -> List[QueryAndResult]:
+        """Executes candidates in order of their best possible score and stops as soon as none of the remaining ones
+        can outrank the best answer found so far, or the deadline expires. Scores and tie-breaking are those of the
+        exhaustive mode; candidates whose result count is unbounded are therefore always executed."""
+        upper_bounds = [self.get_pre_execution_score(query) + self.get_result_score_bound(query) for query in queries]
+        order = sorted(range(len(queries)), key=lambda i: (-upper_bounds[i], i))
 
-                # Set score
-                query_and_result.ranking_score = score
+        ranked = []
+        best = None
+        position = 0
+        wave_size = flask_app.config['QUERY_EXECUTION_WORKERS']
+        while position < len(order):
+            candidate = order[position]
+            if best is not None and (upper_bounds[candidate], -candidate) <= (best[0], -best[1]):
+                break
+            if deadline is not None and deadline.is_expired():
+                self.LOG.warning("Request deadline expired before all candidates that may rank first were executed")
+                break
+
+            wave = order[position:position + wave_size]
+            position += len(wave)
+            for i, result in zip(wave, self.execute_queries([queries[i] for i in wave], deadline)):
+                if not self.is_answer(queries[i], result):
+                    continue
 
-            results = sorted(results, key=lambda q_and_r: -q_and_r.ranking_score)
+                score = self.get_pre_execution_score(queries[i]) + self.get_result_score(queries[i], result)
+                ranked.append((score, i, QueryAndResult(queries[i], result, score)))
+                if best is None or (score, -i) > (best[0], -best[1]):
+                    best = (score, i)
+
+        self.LOG.info(f"Early termination executed {position} of {len(queries)} candidates")
+        return [query_and_result for _, _, query_and_result in sorted(ranked, key=lambda r: (-r[0], r[1]))]
+
+    @classmethod
+    def is_answer(cls, query: FilledQuery, result: Optional[dict]) -> bool:
+        if result is None:  # failed or timed out, already logged
+            return False
+        if query.is_select_query() and len(result['results']['bindings']) == 0:
+            MetricsRegistry.inc(EMPTY_RESULTS)
+            return False
+        return True
+
+    @classmethod
+    def get_pre_execution_score(cls, query: FilledQuery) -> float:
+        all_links = query.get_all_links()
+
+        # add multiplier value of linked candidates, i.e., queries using exact matches rank higher
+        score = sum([link.multiplier for link in all_links])
+
+        # add length of search term of linked candidates, i.e., queries using longer matches phrases rank higher
+        score = score + sum([len(link.originalTerm) for link in all_links])
+
+        # TODO for Proximity questions, rank relation > way > node
+        # if query.geo_operator == Constants.GEO_OPERATOR_PROXIMITY:
+
+        return score
+
+    @classmethod
+    def get_result_score(cls, query: FilledQuery, result: dict) -> float:
+        # add number of results returned, i.e., queries returning more number results rank higher
+        if query.is_select_query():
+            return len(result["results"]["bindings"])
+            # pass # disabling the rule
+        else:  # if ASK query and answer is True, rank higher
+            return 1 if result["boolean"] else 0
+
+    @classmethod
+    def get_result_score_bound(cls, query: FilledQuery) -> float:
+        """Largest score get_result_score can give the query, known from its shape before execution. Infinite for
+        SELECT queries without LIMIT, whose number of results is not known in advance."""
+        if query.is_ask_query() or "COUNT(" in query.query:
+            return 1
+
+        limit = re.search(r"LIMIT (\d+)", query.query)
+        if limit is not None:
+            return int(limit.group(1))
+        return math.inf
+
+    @classmethod
+    def execute_queries(cls, queries: List[FilledQuery], deadline: Deadline = None) -> List[Optional[dict]]:
+        """Executes the queries concurrently, batched where possible, and returns their results in input order.
+        Queries without result when the deadline expires are cancelled, their result is None."""
+        deadline = deadline or Deadline()
+        batches = cls.plan_execution_units(queries)
+        pool = WorkerPools.get_pool("sparql", flask_app.config['QUERY_EXECUTION_WORKERS'])
+        futures = [pool.submit(cls.execute_batch, [queries[i] for i in batch], deadline) for batch in batches]
+
+        _, pending = wait(futures, timeout=deadline.remaining())
+        if len(pending) > 0:
+            # Running executions end at the latest with their own timeout, which is cut to the deadline as well
+            for future in pending:
+                future.cancel()
+            cls.LOG.warning(f"Request deadline expired with {len(pending)} of {len(futures)} query executions pending")
+
+        results = [None] * len(queries)
+        for batch, future in zip(batches, futures):
+            if future in pending:
+                continue
+            for i, result in zip(batch, future.result()):
+                results[i] = result
+
+        return results
+
+    @classmethod
+    def plan_execution_units(cls, queries: List[FilledQuery]) -> List[List[int]]:
+        """Indexes of the queries sent together, as one batch query, or alone."""
+        # Replayed queries are answered from their own fixtures, which do not depend on how they were batched
+        if flask_app.config['QUERY_BATCHING_ENABLED'] and flask_app.config['SPARQL_EXECUTOR'] != "local" and \
+                not FixtureStore.is_replaying():
+            return cls.plan_batches(queries)
+        return [[i] for i in range(len(queries))]
+
+    @classmethod
+    def get_batch_key(cls, query: FilledQuery):
+        """Query text with the linked URIs abstracted into variables, or None if the query cannot be batched."""
+        if not query.is_select_query() or "COUNT(" in query.query or "LIMIT" in query.query or \
+                "VALUES" in query.query:
+            return None
+
+        uris = cls.get_batch_uris(query)
+        template = cls.normalize_query(query.query)
+        for i, uri in enumerate(uris):
+            template = template.replace(f"<{uri}>", f"?batch{i}")
+
+        return template, len(uris)
+
+    @classmethod
+    def get_batch_uris(cls, query: FilledQuery) -> List[str]:
+        return list(dict.fromkeys(link.uri for link in query.used_classes + query.used_entities + query.used_relations))
+
+    @classmethod
+    def plan_batches(cls, queries: List[FilledQuery]) -> List[List[int]]:
+        """Groups the indexes of structurally identical queries, in order of first appearance."""
+        batches = []
+        open_batches = {}
+        for i, query in enumerate(queries):
+            key = cls.get_batch_key(query)
+            if key is None or key[1] == 0:
+                batches.append([i])
+                continue
+
+            batch = open_batches.get(key)
+            if batch is None or len(batch) >= flask_app.config['QUERY_BATCH_SIZE']:
+                batch = []
+                open_batches[key] = batch
+                batches.append(batch)
+            batch.append(i)
+
+        return batches
+
+    @classmethod
+    def execute_batch(cls, queries: List[FilledQuery], deadline: Deadline = None) -> List[Optional[dict]]:
+        if deadline is not None and deadline.is_expired():
+            return [None] * len(queries)
+        if len(queries) == 1:
+            return [cls.execute(queries[0].query, timeout=cls.get_query_timeout(deadline))]
+
+        # Members answered from the cache are not sent again
+        cache = cls.get_result_cache()
+        results = [cache.get(cls.get_cache_key(query.query)) for query in queries]
+        pending = [query for query, result in zip(queries, results) if result is None]
+        if len(pending) <= 1:
+            return [result if result is not None else cls.execute(query.query, timeout=cls.get_query_timeout(deadline))
+                    for query, result in zip(queries, results)]
+
+        batch_query, rows, variable_count = cls.build_batch_query(pending)
+        start = time.perf_counter()
+        batch_result = cls.execute(batch_query, timeout=cls.get_query_timeout(deadline))
+        if batch_result is None:
+            return [result if result is not None else cls.execute(query.query, timeout=cls.get_query_timeout(deadline))
+                    for query, result in zip(queries, results)]
+
+        return cls.split_batch_result(queries, results, batch_result, rows, variable_count, start)
+
+    @classmethod
+    def build_batch_query(cls, pending: List[FilledQuery]) -> Tuple[str, List[tuple], int]:
+        """One query answering all pending (structurally identical) queries, with their URIs in a VALUES block."""
+        template, variable_count = cls.get_batch_key(pending[0])
+        batch_variables = " ".join(f"?batch{i}" for i in range(variable_count))
+        rows = list(dict.fromkeys(tuple(cls.get_batch_uris(query)) for query in pending))
+        values = " ".join("(" + " ".join(f"<{uri}>" for uri in row) + ")" for row in rows)
+        batch_query = re.sub(r"SELECT (.*?) WHERE \{",
+                             lambda m: f"SELECT {m.group(1)} {batch_variables} WHERE {{ "
+                                       f"VALUES ({batch_variables}) {{ {values} }}",
+                             template, count=1)
+        return batch_query, rows, variable_count
+
+    @classmethod
+    def split_batch_result(cls, queries: List[FilledQuery], results: List[Optional[dict]], batch_result: dict,
+                           rows: List[tuple], variable_count: int, start: float = None) -> List[Optional[dict]]:
+        """Splits the combined bindings back by the URIs each original query was filled with. While recording, each
+        split result is also recorded under its own query, with the latency of the batch since start, so that it can
+        be replayed without batching."""
+        cache = cls.get_result_cache()
+        batch_vars = [f"batch{i}" for i in range(variable_count)]
+        head_vars = [var for var in batch_result["head"]["vars"] if var not in batch_vars]
+        bindings_by_row = {row: [] for row in rows}
+        for binding in batch_result["results"]["bindings"]:
+            row = tuple(binding[var]["value"] for var in batch_vars)
+            if row in bindings_by_row:
+                bindings_by_row[row].append({var: value for var, value in binding.items() if var not in batch_vars})
+
+        for i, query in enumerate(queries):
+            if results[i] is None:
+                results[i] = {"head": {"vars": head_vars},
+                              "results": {"bindings": bindings_by_row[tuple(cls.get_batch_uris(query))]}}
+                cache.put(cls.get_cache_key(query.query), results[i])
+                if start is not None:
+                    cls.record_fixture(query.query, json.dumps(results[i]), start)
 
         return results
 
+    @classmethod
+    def deduplicate(cls, queries: List[FilledQuery]) -> List[FilledQuery]:
+        """Keeps one query per canonical key, at the position of its first occurrence. The kept query is the one with
+        the highest pre-execution score, the others are recorded as its duplicates."""
+        kept = {}
+        for query in queries:
+            key = query.get_canonical_key()
+            existing = kept.get(key)
+            if existing is None:
+                kept[key] = query
+            elif cls.get_pre_execution_score(query) > cls.get_pre_execution_score(existing):
+                query.duplicates = existing.duplicates + [existing]
+                existing.duplicates = []
+                kept[key] = query
+            else:
+                existing.duplicates.append(query)
+
+        if len(kept) < len(queries):
+            cls.LOG.info(f"Deduplicated {len(queries)} queries to {len(kept)}")
+        return list(kept.values())
+
     @classmethod
     def pre_execution_filter(cls, queries: List[FilledQuery]):
-        filtered_out = []
+        filtered_out = set()
         for query in queries:
             # For Border/Crossing question, all of used entities must be non point geometry
             if query.geo_operator == Constants.GEO_OPERATOR_BORDER or \
@@ -81,7 +509,7 @@ class QueryExecutor(object):
                         delete = True
                         break
                 if delete:
-                    filtered_out.append(query)
+                    filtered_out.add(query)
                     continue
 
             # For Containment question, at least one used entities should be non point geometry
@@ -93,13 +521,133 @@ class QueryExecutor(object):
                             delete = False
                             break
                     if delete:
-                        filtered_out.append(query)
+                        filtered_out.add(query)
                         continue
 
         return [query for query in queries if query not in filtered_out]
 
 
+class AsyncQueryExecutor(object):
+    """Non-blocking SPARQL execution for the asyncio serving mode, sharing the result cache, batching and ranking of
+    QueryExecutor. In-flight requests to the endpoint are bounded by ASYNC_SPARQL_CONCURRENCY per event loop.
+
+    Candidates are always all executed concurrently, RANKING_MODE does not apply to this mode.
+    """
+    LOG = flask_app.logger
+    _semaphores = {}
+
+    @classmethod
+    def get_semaphore(cls) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphore = cls._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(flask_app.config['ASYNC_SPARQL_CONCURRENCY'])
+            cls._semaphores[loop] = semaphore
+        return semaphore
+
+    @classmethod
+    async def execute(cls, query, sparql_endpoint=None, timeout=None, use_cache=True):
+        start = time.perf_counter()
+        results, source = await cls.execute_timed(query, sparql_endpoint, timeout, use_cache)
+        MetricsRegistry.observe(SPARQL_EXECUTE_SECONDS, time.perf_counter() - start, source=source)
+        return results
+
+    @classmethod
+    async def execute_timed(cls, query, sparql_endpoint=None, timeout=None,
+                            use_cache=True) -> Tuple[Optional[dict], str]:
+        """See QueryExecutor.execute_timed."""
+        cache, cache_key, sparql_endpoint, timeout, use_local_executor = \
+            QueryExecutor.get_execution_target(query, sparql_endpoint, timeout, use_cache)
+
+        answered = QueryExecutor.answer_without_execution(query, cache, cache_key)
+        if answered is not None:
+            results, source, delay = answered
+            if delay > 0:
+                await asyncio.sleep(delay)
+            return results, source
+
+        start = time.perf_counter()
+        if use_local_executor:
+            # Evaluation is CPU bound, so it runs off the event loop
+            results = await asyncio.get_running_loop().run_in_executor(None, QueryExecutor.execute_locally, query)
+            answered = QueryExecutor.finish_local_execution(query, results, cache, cache_key, start)
+            if answered is not None:
+                return answered
+
+        try:
+            async with cls.get_semaphore():
+                status, text = await AsyncHttpSessionProvider.post(
+                    sparql_endpoint, {"query": query}, headers={"Accept": "application/sparql-results+json"},
+                    read_timeout=timeout)
+            if status != 200:
+                raise Exception(f"Response status code: {status}")
+            return QueryExecutor.store_results(query, json.loads(text), text, cache, cache_key, start), "remote"
+        except Exception as e:
+            cls.LOG.error(f"Query execution failed: {query}")
+            cls.LOG.error(f"Error: {str(e)}")
+            return None, "failed"
+
+    @classmethod
+    async def execute_batch(cls, queries: List[FilledQuery], deadline: Deadline = None) -> List[Optional[dict]]:
+        if deadline is not None and deadline.is_expired():
+            return [None] * len(queries)
+        if len(queries) == 1:
+            return [await cls.execute(queries[0].query, timeout=QueryExecutor.get_query_timeout(deadline))]
+
+        cache = QueryExecutor.get_result_cache()
+        results = [cache.get(QueryExecutor.get_cache_key(query.query)) for query in queries]
+        pending = [query for query, result in zip(queries, results) if result is None]
+        if len(pending) > 1:
+            batch_query, rows, variable_count = QueryExecutor.build_batch_query(pending)
+            start = time.perf_counter()
+            batch_result = await cls.execute(batch_query, timeout=QueryExecutor.get_query_timeout(deadline))
+            if batch_result is not None:
+                return QueryExecutor.split_batch_result(queries, results, batch_result, rows, variable_count, start)
+
+        return [result if result is not None else
+                await cls.execute(query.query, timeout=QueryExecutor.get_query_timeout(deadline))
+                for query, result in zip(queries, results)]
+
+    @classmethod
+    async def execute_queries(cls, queries: List[FilledQuery], deadline: Deadline = None) -> List[Optional[dict]]:
+        """Results in input order. Queries without result when the deadline expires are cancelled, their result is
+        None."""
+        deadline = deadline or Deadline()
+        batches = QueryExecutor.plan_execution_units(queries)
+        tasks = [asyncio.ensure_future(cls.execute_batch([queries[i] for i in batch], deadline)) for batch in batches]
+        if len(tasks) == 0:
+            return []
+
+        _, pending = await asyncio.wait(tasks, timeout=deadline.remaining())
+        if len(pending) > 0:
+            for task in pending:
+                task.cancel()
+            cls.LOG.warning(f"Request deadline expired with {len(pending)} of {len(tasks)} query executions pending")
+
+        results = [None] * len(queries)
+        for batch, task in zip(batches, tasks):
+            if task in pending:
+                continue
+            for i, result in zip(batch, task.result()):
+                results[i] = result
+
+        return results
+
+    @classmethod
+    async def execute_and_rank(cls, queries: List[FilledQuery], deadline: Deadline = None) -> List[QueryAndResult]:
+        if len(queries) == 0:
+            return []
+
+        queries = QueryExecutor.prepare(queries)
+        return QueryExecutor.rank(queries, await cls.execute_queries(queries, deadline))
+
+
+MetricsRegistry.register_cache("sparql", QueryExecutor.get_result_cache)
+CacheGeneration.register(QueryExecutor.invalidate_cache)
+
+
 if __name__ == '__main__':
     QueryExecutor.execute(
         "PREFIX geo: <http://www.opengis.net/ont/geosparql#> PREFIX uom: <http://www.opengis.net/def/uom/OGC/1.0/> PREFIX geof: <http://www.opengis.net/def/function/geosparql/> SELECT DISTINCT (COUNT(?target) AS ?count) WHERE { <http://linkedgeodata.org/triplify/relation62718> geo:hasGeometry ?aGeom . ?aGeom geo:asWKT ?aWKT . ?target geo:hasGeometry ?tGeom ; a <http://linkedgeodata.org/ontology/Castle> . ?tGeom geo:asWKT ?tWKT BIND(geof:sfContains(?aWKT, ?tWKT) AS ?contains) FILTER ( ?contains && ( ! sameTerm(?aWKT, ?tWKT) ) ) }",
         sparql_endpoint="http://geo-qa.cs.upb.de:3030/bremen_geo/sparql")
+
@@ -1,26 +1,76 @@
 import itertools
+import json
 import re
-from typing import List, Tuple
-
-import spacy
-from spacytextblob.spacytextblob import SpacyTextBlob
+from typing import List, Optional, Tuple
 
 from geoqa import app as flask_app
-from geoqa.model.beans import LinkingResponse, FilledPattern, LinkedCandidate, Constants, FilledQuery
+from geoqa.core.geometry_cache import GeometryMetadataCache, ProximityGridIndex
+from geoqa.core.query_template import QueryTemplate
+from geoqa.core.topology import TopologyMaterializer
+from geoqa.model.beans import LinkingResponse, FilledPattern, LinkedCandidate, Constants, FilledQuery, \
+    QuestionFeatures
+from geoqa.util.cache_utils import LRUCache
+from geoqa.util.concurrency_utils import Deadline
+from geoqa.util.metrics_utils import MetricsRegistry
+from geoqa.util.nlp_utils import NlpProvider
 from geoqa.util.property_utils import PropertyUtils
-
-nlp = spacy.load("en_core_web_sm")
-nlp.add_pipe('spacytextblob')
+from geoqa.util.store_utils import ServiceResponseStore
 
 
 class QueryGenerator:
     LOG = flask_app.logger
-
-    def __init__(self, question: str, geo_operator: str, linking_info: LinkingResponse):
+    QUERY_ANATOMY = QueryTemplate("anatomy", Constants.QUERY_ANATOMY)
+    QUERY_COUNT_VARIABLE = QueryTemplate("count", Constants.QUERY_COUNT_VARIABLE)
+    # Slots filled by apply_combination, and by populate_query_anatomy for the given operator only
+    PATTERN_SLOTS = {Constants.CLASS_PLACEHOLDER, Constants.ENTITY_PLACEHOLDER, Constants.QUERY_BBOX_FILTER,
+                     Constants.QUERY_PROXIMITY_CANDIDATES, Constants.QUERY_RELATION, Constants.QUERY_RELATION_FILTER}
+    OPERATOR_PATTERN_SLOTS = {Constants.GEO_OPERATOR_PROXIMITY: {Constants.QUERY_PROXIMITY_VALUE}}
+    ANATOMY_SLOTS = {Constants.QUERY_PREFIXES, Constants.QUERY_FORM, Constants.QUERY_VARIABLE,
+                     Constants.QUERY_WHERE_CLAUSE, Constants.QUERY_ORDERING, Constants.QUERY_LIMIT}
+    _templates = None
+    _features_cache = None
+
+    @classmethod
+    def load_templates(cls):
+        """Compiles all patterns of query_templates.yml once, failing on placeholders that would be left unfilled."""
+        cls.check_slots(cls.QUERY_ANATOMY, cls.ANATOMY_SLOTS)
+        cls.check_slots(cls.QUERY_COUNT_VARIABLE, {Constants.QUERY_VARIABLE})
+
+        templates = {}
+        for geo_operator, patterns in PropertyUtils.get_all_query_templates().items():
+            templates[geo_operator] = {}
+            slots = cls.PATTERN_SLOTS.union(cls.OPERATOR_PATTERN_SLOTS.get(geo_operator, set()))
+            for key, info in patterns.items():
+                compiled = dict(info)
+                for pattern_key in ("pattern", "materialized_pattern"):
+                    if pattern_key in info:
+                        template = QueryTemplate(f"{geo_operator}.{key}.{pattern_key}", info[pattern_key])
+                        cls.check_slots(template, slots)
+                        # Every link of the combination named by the key fills one class or entity occurrence
+                        for category, placeholder in ((Constants.CLASS, Constants.CLASS_PLACEHOLDER),
+                                                      (Constants.ENTITY, Constants.ENTITY_PLACEHOLDER)):
+                            if template.get_occurrences(placeholder) != key.split("__").count(category):
+                                raise ValueError(f"Query template {template.name} does not have one {placeholder} "
+                                                 f"per {category} of its combination")
+                        compiled[pattern_key] = template
+                templates[geo_operator][key] = compiled
+
+        cls._templates = templates
+
+    @classmethod
+    def check_slots(cls, template: QueryTemplate, slots: set):
+        unfilled = template.placeholders.difference(slots)
+        if len(unfilled) > 0:
+            raise ValueError(f"Placeholders {sorted(unfilled)} of query template {template.name} are never filled")
+
+    def __init__(self, question: str, geo_operator: str, linking_info: LinkingResponse,
+                 features: QuestionFeatures = None, deadline: Deadline = None):
         self.question = question
-        self.parsed_question = nlp(question)
+        self.features = features if features is not None else self.get_question_features(question)
         self.geo_operator = geo_operator
         self.linking_info = linking_info
+        # Bounds the geometry lookups, which are skipped once it expired
+        self.deadline = deadline or Deadline()
 
     def generate_queries(self):
         links_by_position = {}
@@ -90,7 +140,7 @@ class QueryGenerator:
         return return_value
 
     def fill_patterns(self, triple_patterns) -> List[FilledPattern]:
-        basic_patterns = PropertyUtils.get_query_templates(self.geo_operator)
+        basic_patterns = self._templates[self.geo_operator]
 
         filled_patterns: List[FilledPattern] = []
         for triple_pattern in triple_patterns:
@@ -102,8 +152,9 @@ class QueryGenerator:
             if query_pattern_info is not None:
                 self.LOG.info(f"Basic pattern: {basic_pattern_key}")
 
-                query_pattern = query_pattern_info.get("pattern")
+                query_pattern = self.select_query_pattern(query_pattern_info)
                 variable = query_pattern_info.get("variable")
+                bbox_variable = query_pattern_info.get("bbox_variable")
 
                 # Make combinations
                 combinations = []
@@ -131,161 +182,288 @@ class QueryGenerator:
                     combinations = [c for c in combinations if c[0].startIndex != c[1].startIndex]
 
                 for combination in combinations:
-                    filled: List[FilledPattern] = self.apply_combination(query_pattern, variable, combination)
+                    filled: List[FilledPattern] = self.apply_combination(query_pattern, variable, combination,
+                                                                         bbox_variable)
                     filled_patterns.extend(filled)
 
         return filled_patterns
 
-    def apply_combination(self, query_template: str, variable: str,
-                          combination: Tuple[LinkedCandidate]) -> List[FilledPattern]:
+    @classmethod
+    def select_query_pattern(cls, query_pattern_info: dict) -> QueryTemplate:
+        # Look up precomputed topological relations instead of evaluating geof functions, if they are up to date
+        if "materialized_pattern" in query_pattern_info and TopologyMaterializer.is_available():
+            return query_pattern_info.get("materialized_pattern")
+
+        return query_pattern_info.get("pattern")
+
+    def apply_combination(self, query_template: QueryTemplate, variable: str, combination: Tuple[LinkedCandidate],
+                          bbox_variable: str = None) -> List[FilledPattern]:
 
         filled_patterns = []
 
-        filled = query_template
+        slot_values = {Constants.CLASS_PLACEHOLDER: [], Constants.ENTITY_PLACEHOLDER: []}
         used_classes = []
         used_entities = []
         used_relations = []
 
-        # Handle class and entities as part of the combination
+        # Handle class and entities as part of the combination, each link fills the next placeholder of its kind
         for link in combination:
             if link.is_class():
-                filled = filled.replace(Constants.CLASS_PLACEHOLDER, f"<{link.uri}>")
+                slot_values[Constants.CLASS_PLACEHOLDER].append(f"<{link.uri}>")
                 used_classes.append(link)
             elif link.is_entity():
-                filled = filled.replace(Constants.ENTITY_PLACEHOLDER, f"<{link.uri}>")
+                slot_values[Constants.ENTITY_PLACEHOLDER].append(f"<{link.uri}>")
                 used_entities.append(link)
 
+        # The bounding box is looked up only for templates that use it, materialized patterns do not
+        if Constants.QUERY_BBOX_FILTER in query_template.placeholders:
+            slot_values[Constants.QUERY_BBOX_FILTER] = self.get_bbox_filter(bbox_variable, used_entities)
+        if Constants.QUERY_PROXIMITY_CANDIDATES in query_template.placeholders:
+            slot_values[Constants.QUERY_PROXIMITY_CANDIDATES] = \
+                self.get_proximity_candidates(variable, used_classes, used_entities)
+
         # Handle relations as an additional constrains that targets the selected variable
         if len(self.linking_info.linkedRelations) > 0:
             for relation in self.linking_info.linkedRelations:
-                filled_with_relation = str(filled)
+                relation_slot_values = dict(slot_values)
                 relation_triple_pattern = \
                     f'{variable} <{relation.uri}> {Constants.QUERY_RELATION_VARIABLE_RAW} . ' \
                     f'BIND(xsd:float(REPLACE(xsd:string({Constants.QUERY_RELATION_VARIABLE_RAW}), "[^\\\\d\\\\.,]", ""))' \
                     f' AS {Constants.QUERY_RELATION_VARIABLE})'
 
-                filled_with_relation = filled_with_relation.replace(Constants.QUERY_RELATION, relation_triple_pattern)
-                if self.get_comparative_token() is not None:
+                relation_slot_values[Constants.QUERY_RELATION] = relation_triple_pattern
+                if self.is_comparative_present():
                     relation_filter = self.get_relation_filter(Constants.QUERY_RELATION_VARIABLE)
                     if relation_filter is None:
                         continue
 
-                    filled_with_relation = filled_with_relation.replace(Constants.QUERY_RELATION_FILTER, relation_filter)
+                    relation_slot_values[Constants.QUERY_RELATION_FILTER] = relation_filter
                     used_relations.append(relation)
                 else:
-                    filled_with_relation = filled_with_relation.replace(Constants.QUERY_RELATION_FILTER, "")
+                    relation_slot_values[Constants.QUERY_RELATION_FILTER] = ""
                     used_relations.append(relation)
 
-                filled_patterns.append(FilledPattern(filled_with_relation, variable, used_classes=used_classes,
-                                                     used_relations=used_relations, used_entities=used_entities))
+                filled_patterns.append(FilledPattern(query_template, variable, used_classes=used_classes,
+                                                     used_relations=used_relations, used_entities=used_entities,
+                                                     slot_values=relation_slot_values))
 
         else:
-            filled = filled.replace(Constants.QUERY_RELATION, "")
-            filled = filled.replace(Constants.QUERY_RELATION_FILTER, "")
-            filled_patterns.append(
-                FilledPattern(filled, variable, used_classes=used_classes, used_entities=used_entities))
+            slot_values[Constants.QUERY_RELATION] = ""
+            slot_values[Constants.QUERY_RELATION_FILTER] = ""
+            filled_patterns.append(FilledPattern(query_template, variable, used_classes=used_classes,
+                                                 used_entities=used_entities, slot_values=slot_values))
 
         return filled_patterns
 
-    def is_superlative_present(self):
-        return self.get_superlative_token() is not None
-
-    def get_superlative_token(self):
-        for token in self.parsed_question:
-            if token.tag_ == "JJS":
-                return token
-
-        return None
+    def get_bbox_filter(self, bbox_variable: str, used_entities: List[LinkedCandidate]) -> str:
+        """Cheap bounding box test on the target geometry, evaluated before the exact topology function."""
+        if not flask_app.config['BBOX_PREFILTER_ENABLED'] or bbox_variable is None or len(used_entities) != 1 or \
+                self.deadline.is_expired():
+            return ""
+
+        bbox = GeometryMetadataCache.get_bbox(used_entities[0].uri, self.deadline)
+        if bbox is None:
+            return ""
+
+        # Targets touching, crossing or inside the entity intersect its bbox, close ones intersect the widened bbox.
+        # The minimum margin keeps the bbox of point entities a valid polygon.
+        margin = self.get_proximity_distance() if self.geo_operator == Constants.GEO_OPERATOR_PROXIMITY else 1.0
+        bbox_literal = GeometryMetadataCache.to_wkt_literal(GeometryMetadataCache.expand_bbox(bbox, margin))
+        return f"FILTER(geof:sfIntersects({bbox_variable}, {bbox_literal}))"
+
+    def get_proximity_candidates(self, variable: str, used_classes: List[LinkedCandidate],
+                                 used_entities: List[LinkedCandidate]) -> str:
+        """VALUES block restricting the target variable to instances in grid cells within the requested distance."""
+        if not flask_app.config['PROXIMITY_INDEX_ENABLED'] or variable is None or \
+                len(used_classes) != 1 or len(used_entities) != 1 or self.deadline.is_expired():
+            return ""
+
+        anchor_bbox = GeometryMetadataCache.get_bbox(used_entities[0].uri, self.deadline)
+        index = ProximityGridIndex.get_index(used_classes[0].uri) if anchor_bbox is not None else None
+        if index is None:
+            return ""
+
+        candidates = index.get_candidates(anchor_bbox, self.get_proximity_distance())
+        if candidates is None or len(candidates) > flask_app.config['PROXIMITY_VALUES_LIMIT']:
+            return ""
+
+        return f"VALUES {variable} {{ {' '.join(f'<{uri}>' for uri in sorted(candidates))} }}"
+
+    @classmethod
+    def get_question_features(cls, question: str) -> QuestionFeatures:
+        """Features of the question from memory, the persistent store or, failing both, a fresh spaCy parse."""
+        features = cls.get_cached_question_features(question)
+        if features is None:
+            features = cls.extract_question_features(NlpProvider.get_nlp()(question))
+            cls.put_question_features(question, features)
+
+        return features
+
+    @classmethod
+    def get_questions_features(cls, questions: List[str]) -> List[QuestionFeatures]:
+        """Features of several questions, the ones not cached yet are parsed together with nlp.pipe."""
+        features = [cls.get_cached_question_features(question) for question in questions]
+        missing = [i for i, question_features in enumerate(features) if question_features is None]
+        if len(missing) > 0:
+            parsed_questions = NlpProvider.get_nlp().pipe([questions[i] for i in missing],
+                                                          batch_size=flask_app.config['SPACY_BATCH_SIZE'])
+            for i, parsed_question in zip(missing, parsed_questions):
+                features[i] = cls.extract_question_features(parsed_question)
+                cls.put_question_features(questions[i], features[i])
+
+        return features
+
+    @classmethod
+    def get_features_store_key(cls) -> str:
+        return f"question-features:{QuestionFeatures.VERSION}:{NlpProvider.get_model_name()}"
+
+    @classmethod
+    def get_cached_question_features(cls, question: str) -> Optional[QuestionFeatures]:
+        features = cls.get_features_cache().get(question)
+        if features is None:
+            stored = ServiceResponseStore.get(cls.get_features_store_key(), False, question)
+            if stored is not None:
+                features = QuestionFeatures.from_dict(json.loads(stored))
+                cls.get_features_cache().put(question, features)
+
+        return features
+
+    @classmethod
+    def put_question_features(cls, question: str, features: QuestionFeatures):
+        cls.get_features_cache().put(question, features)
+        ServiceResponseStore.put(cls.get_features_store_key(), False, question, json.dumps(features.to_dict()))
+
+    @classmethod
+    def get_features_cache(cls) -> LRUCache:
+        if cls._features_cache is None:
+            cls._features_cache = LRUCache(flask_app.config['QUESTION_FEATURES_CACHE_SIZE'])
+        return cls._features_cache
+
+    @classmethod
+    def extract_question_features(cls, parsed_question) -> QuestionFeatures:
+        superlative = None
+        comparative = None
+        filter_value = None
+        distance = None
+        for token in parsed_question:
+            if superlative is None and token.tag_ == "JJS":
+                superlative = token
+            if comparative is None and token.tag_ == "JJR":
+                comparative = token
+            if token.pos_ != "NUM":
+                continue
+
+            # The last number in the question is the value for comparisons
+            value = cls.parse_number(token.text)
+            if value is not None and re.search("\\d", token.text) is not None:
+                filter_value = value
+
+            # The last number followed by a unit is the distance for proximity, in metres
+            if value is not None and token.i + 1 < len(parsed_question):
+                next_token = parsed_question[token.i + 1]
+                unit_search = re.search(r'm|km|(kilo)?\s?(meter|metre)s?', next_token.text)
+                if unit_search is not None:
+                    if unit_search.group().lower().startswith("m"):
+                        distance = value
+                    elif unit_search.group().lower().startswith("k"):
+                        distance = value * 1000
+
+        if len(parsed_question) > 0 and parsed_question[0].lemma_ in ("do", "be"):
+            query_form = Constants.QUERY_FORM_ASK
+        else:
+            query_form = Constants.QUERY_FORM_SELECT
+
+        # todo improve with classifier
+        count_applicable = parsed_question[:2].lemma_ == "how many"
+
+        return QuestionFeatures(query_form, count_applicable,
+                                superlative.text if superlative is not None else None,
+                                superlative._.polarity if superlative is not None else 0.0,
+                                comparative.text if comparative is not None else None,
+                                comparative._.polarity if comparative is not None else 0.0,
+                                filter_value, distance)
+
+    @classmethod
+    def parse_number(cls, text: str):
+        try:
+            return float(text.replace(",", ""))
+        except ValueError:
+            return None
 
-    def get_comparative_token(self):
-        for token in self.parsed_question:
-            if token.tag_ == "JJR":
-                return token
+    def is_superlative_present(self):
+        return self.features.superlative is not None
 
-        return None
+    def is_comparative_present(self):
+        return self.features.comparative is not None
 
     def get_relation_filter(self, filter_variable: str):
-        filter_value = None
-        for token in self.parsed_question:
-            if token.pos_ == "NUM" and re.search("\\d", token.text) is not None:
-                filter_value = float(token.text)
-
-        if filter_value is None:
+        if self.features.filter_value is None:
             return None
 
-        comparative = self.get_comparative_token()
-        comparison_operator = ">" if comparative._.polarity > 0 else "<"
-        return f"FILTER ({filter_variable} {comparison_operator} {str(filter_value)})"
+        comparison_operator = ">" if self.features.comparative_polarity > 0 else "<"
+        return f"FILTER ({filter_variable} {comparison_operator} {str(self.features.filter_value)})"
+
+    def get_proximity_distance(self) -> float:
+        """Distance in metres mentioned in the question, e.g. '2 km', or the default proximity distance."""
+        if self.features.distance is not None:
+            return self.features.distance
+        return Constants.DEFAULT_PROXIMITY_DISTANCE
 
     def determine_query_form(self) -> str:
-        if self.parsed_question[0].lemma_ == "do" or self.parsed_question[0].lemma_ == "be":
-            return Constants.QUERY_FORM_ASK
-        else:
-            return Constants.QUERY_FORM_SELECT
+        return self.features.query_form
 
-    def should_apply_count_aggregate(self):  # todo improve with classifier
-        first_two_words = self.parsed_question[:2].lemma_
-        return first_two_words == "how many"
+    def should_apply_count_aggregate(self):
+        return self.features.count_applicable
 
     def populate_query_anatomy(self, query_form: str, count_applicable: bool,
                                filled_triple_patterns: List[FilledPattern]) -> List[FilledQuery]:
         queries = []
-        for triple_pattern in filled_triple_patterns:
-            # Set prefixes
-            query = Constants.QUERY_ANATOMY.replace(Constants.QUERY_PREFIXES, Constants.QUERY_COMMON_PREFIXES)
 
-            # Set query form SELECT/ASK
-            query = query.replace(Constants.QUERY_FORM, query_form)
+        # Set ordering and limit
+        if self.is_superlative_present():
+            if self.features.superlative_polarity > 0:
+                ordering = f"ORDER BY DESC({Constants.QUERY_RELATION_VARIABLE})"
+            else:
+                ordering = f"ORDER BY ASC({Constants.QUERY_RELATION_VARIABLE})"
+            limit = "LIMIT 1"
+        else:
+            ordering = ""
+            limit = ""
+
+        # For proximity query, distance must be extracted
+        pattern_values = {}
+        if self.geo_operator == Constants.GEO_OPERATOR_PROXIMITY:
+            pattern_values[Constants.QUERY_PROXIMITY_VALUE] = str(self.get_proximity_distance())
 
+        for triple_pattern in filled_triple_patterns:
             # Set selected variable
             if query_form == Constants.QUERY_FORM_SELECT:
                 # Prevent invalid patterns
                 if triple_pattern.variable is None:
                     continue
 
+                variables = triple_pattern.variable
                 if count_applicable:
-                    query = query.replace(Constants.QUERY_VARIABLE, Constants.QUERY_COUNT_VARIABLE)
-
-                query = query.replace(Constants.QUERY_VARIABLE, triple_pattern.variable)
+                    variables = self.QUERY_COUNT_VARIABLE.render({Constants.QUERY_VARIABLE: variables})
             else:
-                query = query.replace(Constants.QUERY_VARIABLE, "")
-
-            # Set where clause
-            query = query.replace(Constants.QUERY_WHERE_CLAUSE, triple_pattern.query_template)
-
-            # Set ordering and limit
-            if self.is_superlative_present():
-                if self.get_superlative_token()._.polarity > 0:
-                    ordering = f"ORDER BY DESC({Constants.QUERY_RELATION_VARIABLE})"
-                else:
-                    ordering = f"ORDER BY ASC({Constants.QUERY_RELATION_VARIABLE})"
-
-                query = query.replace(Constants.QUERY_ORDERING, ordering)
-                query = query.replace(Constants.QUERY_LIMIT, "LIMIT 1")
-            else:
-                query = query.replace(Constants.QUERY_ORDERING, "")
-                query = query.replace(Constants.QUERY_LIMIT, "")
-
-            # For proximity query, distance must be extracted
-            if self.geo_operator == Constants.GEO_OPERATOR_PROXIMITY:
-                distance = None
-                for token in self.parsed_question:
-                    if token.pos_ == "NUM":
-                        next_token = self.parsed_question[token.i + 1]
-                        unit_search = re.search(r'm|km|(kilo)?\s?(meter|metre)s?', next_token.text)
-                        if unit_search is not None:
-                            if unit_search.group().lower().startswith("m"):
-                                distance = float(token.text)
-                            elif unit_search.group().lower().startswith("k"):
-                                distance = float(token.text) * 1000
-
-                if distance is not None:
-                    query = query.replace(Constants.QUERY_PROXIMITY_VALUE, str(distance))
-                else:
-                    query = query.replace(Constants.QUERY_PROXIMITY_VALUE, "250")
+                variables = ""
+
+            where_clause = triple_pattern.query_template.render({**triple_pattern.slot_values, **pattern_values})
+            query = self.QUERY_ANATOMY.render({
+                Constants.QUERY_PREFIXES: Constants.QUERY_COMMON_PREFIXES,
+                Constants.QUERY_FORM: query_form,
+                Constants.QUERY_VARIABLE: variables,
+                Constants.QUERY_WHERE_CLAUSE: where_clause,
+                Constants.QUERY_ORDERING: ordering,
+                Constants.QUERY_LIMIT: limit
+            })
 
             queries.append(FilledQuery(query.strip(), query_form, used_classes=triple_pattern.used_classes,
                                        used_relations=triple_pattern.used_relations,
                                        used_entities=triple_pattern.used_entities))
 
         return queries
+
+
+QueryGenerator.load_templates()
+MetricsRegistry.register_cache("question_features", QueryGenerator.get_features_cache)
@@ -0,0 +1,52 @@
+import re
+from typing import List, Union
+
+from geoqa.model.beans import Constants
+
+
+class QueryTemplate(object):
+    """A query template split once into literal text and placeholder slots, rendered in a single pass.
+
+    Slot values are given per placeholder name. A list value fills the occurrences of its placeholder in order,
+    e.g. the two __ENTITY__ slots of an ENTITY__ENTITY pattern.
+    """
+    PLACEHOLDER_REGEX = re.compile(r"(__[A-Z]+(?:_[A-Z]+)*__)")
+
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self.text = text
+        # Even positions hold literal text, odd positions hold placeholder names
+        self.tokens: List[str] = self.PLACEHOLDER_REGEX.split(text)
+        self.placeholders = set(self.tokens[1::2])
+
+        unknown = self.placeholders.difference(Constants.QUERY_PLACEHOLDERS)
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown placeholders {sorted(unknown)} in query template {name}")
+
+    def __str__(self) -> str:
+        return self.text
+
+    def __repr__(self) -> str:
+        return self.text
+
+    def get_occurrences(self, placeholder: str) -> int:
+        return self.tokens[1::2].count(placeholder)
+
+    def render(self, values: dict) -> str:
+        positions = {}
+        parts = []
+        for i, token in enumerate(self.tokens):
+            if i % 2 == 0:
+                parts.append(token)
+                continue
+
+            value: Union[str, list] = values.get(token)
+            if isinstance(value, list):
+                position = positions.get(token, 0)
+                positions[token] = position + 1
+                value = value[position] if position < len(value) else None
+            if value is None:
+                raise ValueError(f"Placeholder {token} left unfilled in query template {self.name}")
+            parts.append(value)
+
+        return "".join(parts)
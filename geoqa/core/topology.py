@@ -0,0 +1,147 @@
+import json
+import os
+import sys
+import time
+
+from shapely.strtree import STRtree
+
+from geoqa import app as flask_app
+from geoqa.core.local_executor import LocalGeoSparqlEngine
+from geoqa.core.query_executor import QueryExecutor
+from geoqa.model.beans import Constants
+
+GEO_NAMESPACE = "http://www.opengis.net/ont/geosparql#"
+MARKER_SUBJECT = "http://geo-qa.cs.upb.de/topology"
+MARKER_PREDICATE = "http://geo-qa.cs.upb.de/topology#build"
+
+
+class TopologyMaterializer(object):
+    """Precomputes the topological relations used by the Borders, Containment and Crossing templates.
+
+    The build writes geo:sfTouches, geo:sfCrosses and geo:sfContains triples between the features of a knowledge
+    base dump to an N-Triples file, which is loaded into the dataset next to the dump, plus a metadata file
+    recording which dump and KB_VERSION it was computed from. Touches and crosses are computed between way and
+    relation geometries; contains from ways and relations to every feature, so that nodes inside areas are found.
+
+    The N-Triples also hold a marker triple naming the KB_VERSION and build time. The relations are only used once
+    the endpoint answers an ASK for that marker, so a dataset the file was never loaded into keeps using the geof
+    function patterns instead of silently returning no results.
+    """
+    LOG = flask_app.logger
+    FRESHNESS_CHECK_INTERVAL = 60
+    _available = None
+    _checked_at = 0.0
+
+    @classmethod
+    def get_metadata_path(cls, output_path: str) -> str:
+        return output_path + ".json"
+
+    @classmethod
+    def get_dump_fingerprint(cls, dump_path: str):
+        if not os.path.exists(dump_path):
+            return None
+        stat = os.stat(dump_path)
+        return {"size": stat.st_size, "mtime": int(stat.st_mtime)}
+
+    @classmethod
+    def is_area(cls, engine: LocalGeoSparqlEngine, feature: str) -> bool:
+        return feature in engine.instances.get(Constants.WAY_CLASS, ()) or \
+               feature in engine.instances.get(Constants.RELATION_CLASS, ()) or \
+               "/triplify/way" in feature or "/triplify/relation" in feature
+
+    @classmethod
+    def build(cls, dump_path: str, output_path: str) -> dict:
+        start = time.time()
+        engine = LocalGeoSparqlEngine(dump_path)
+        entries = [entry for feature_entries in engine.geometries.values() for entry in feature_entries]
+        tree = STRtree([entry.geometry for entry in entries])
+
+        triples = set()
+        for area in entries:
+            if not cls.is_area(engine, area.feature):
+                continue
+
+            for i in tree.query(area.geometry):
+                other = entries[i]
+                if other.feature == area.feature or other.wkt == area.wkt:
+                    continue
+
+                if area.geometry.contains(other.geometry):
+                    triples.add((area.feature, "sfContains", other.feature))
+                if cls.is_area(engine, other.feature):
+                    if area.geometry.touches(other.geometry):
+                        triples.add((area.feature, "sfTouches", other.feature))
+                    if area.geometry.crosses(other.geometry):
+                        triples.add((area.feature, "sfCrosses", other.feature))
+
+        built_at = int(time.time())
+        marker = f"{flask_app.config['KB_VERSION']}/{built_at}"
+        with open(output_path, "w") as output:
+            for subject, relation, obj in sorted(triples):
+                output.write(f"<{subject}> <{GEO_NAMESPACE}{relation}> <{obj}> .\n")
+            output.write(f"<{MARKER_SUBJECT}> <{MARKER_PREDICATE}> {json.dumps(marker)} .\n")
+
+        metadata = {
+            "dump_path": os.path.abspath(dump_path),
+            "dump": cls.get_dump_fingerprint(dump_path),
+            "kb_version": flask_app.config['KB_VERSION'],
+            "built_at": built_at,
+            "marker": marker,
+            "relations": {relation: sum(1 for t in triples if t[1] == relation)
+                          for relation in ("sfContains", "sfTouches", "sfCrosses")}
+        }
+        with open(cls.get_metadata_path(output_path), "w") as metadata_file:
+            json.dump(metadata, metadata_file, indent=2)
+
+        cls.LOG.info(f"Materialized {len(triples)} topological relations in {time.time() - start:.1f}s")
+        return metadata
+
+    @classmethod
+    def is_fresh(cls, metadata: dict) -> bool:
+        if metadata.get("kb_version") != flask_app.config['KB_VERSION']:
+            return False
+
+        # When the dump is available on this host, it must not have changed since the build
+        current = cls.get_dump_fingerprint(metadata.get("dump_path", ""))
+        return current is None or current == metadata.get("dump")
+
+    @classmethod
+    def is_loaded(cls, metadata: dict) -> bool:
+        """Whether the endpoint holds the marker triple of this build. The local executor evaluates the relations
+        itself from the dump."""
+        if flask_app.config['SPARQL_EXECUTOR'] == "local":
+            return True
+        if "marker" not in metadata:
+            return False
+
+        marker_query = f"ASK {{ <{MARKER_SUBJECT}> <{MARKER_PREDICATE}> {json.dumps(metadata['marker'])} }}"
+        result = QueryExecutor.execute(marker_query, use_cache=False)
+        return result is not None and result.get("boolean", False)
+
+    @classmethod
+    def is_available(cls) -> bool:
+        """Whether queries may use the materialized relations, re-checked at most once per check interval."""
+        output_path = flask_app.config['TOPOLOGY_MATERIALIZATION_PATH']
+        if not output_path:
+            return False
+
+        if cls._available is None or time.monotonic() - cls._checked_at > cls.FRESHNESS_CHECK_INTERVAL:
+            try:
+                with open(cls.get_metadata_path(output_path)) as metadata_file:
+                    metadata = json.load(metadata_file)
+                available = cls.is_fresh(metadata) and cls.is_loaded(metadata)
+            except (OSError, ValueError) as e:
+                cls.LOG.error(f"Failed to read topology materialization metadata: {str(e)}")
+                available = False
+
+            if not available:
+                cls.LOG.warning("Topology materialization is missing, stale or not loaded into the endpoint, "
+                                "falling back to geof functions")
+            cls._available = available
+            cls._checked_at = time.monotonic()
+
+        return cls._available
+
+
+if __name__ == '__main__':
+    print(TopologyMaterializer.build(sys.argv[1], sys.argv[2]))
@@ -1,3 +1,4 @@
+import re
 from typing import List
 
 
@@ -18,6 +19,9 @@ class Constants(object):
     GEO_OPERATOR_CROSSING = "Crossing"
     GEO_OPERATOR_PROXIMITY = "Proximity"
 
+    # Operators whose relation does not depend on the order of its two arguments
+    SYMMETRIC_GEO_OPERATORS = [GEO_OPERATOR_BORDER]
+
     GEO_OPERATOR_PATTERN = {
         GEO_OPERATOR_BORDER: "__BORDERS__",
         GEO_OPERATOR_CONTAINMENT: "__CONTAINED_IN__",
@@ -35,12 +39,20 @@ class Constants(object):
     QUERY_PROXIMITY_VALUE = "__DISTANCE__"
     QUERY_RELATION = "__RELATION__"
     QUERY_RELATION_FILTER = "__RELATION_FILTER__"
+    QUERY_BBOX_FILTER = "__BBOX_FILTER__"
+    QUERY_PROXIMITY_CANDIDATES = "__PROXIMITY_CANDIDATES__"
     QUERY_RELATION_VARIABLE_RAW = "?valueRaw"
     QUERY_RELATION_VARIABLE = "?value"
 
+    QUERY_PLACEHOLDERS = {CLASS_PLACEHOLDER, ENTITY_PLACEHOLDER, QUERY_PREFIXES, QUERY_FORM, QUERY_VARIABLE,
+                          QUERY_WHERE_CLAUSE, QUERY_ORDERING, QUERY_LIMIT, QUERY_PROXIMITY_VALUE, QUERY_RELATION,
+                          QUERY_RELATION_FILTER, QUERY_BBOX_FILTER, QUERY_PROXIMITY_CANDIDATES}
+
     QUERY_FORM_SELECT = "SELECT"
     QUERY_FORM_ASK = "ASK"
 
+    DEFAULT_PROXIMITY_DISTANCE = 250.0
+
     QUERY_ANATOMY = f"{QUERY_PREFIXES} {QUERY_FORM} {QUERY_VARIABLE} WHERE {QUERY_WHERE_CLAUSE} {QUERY_ORDERING} {QUERY_LIMIT}"
     QUERY_COMMON_PREFIXES = """PREFIX uom: <http://www.opengis.net/def/uom/OGC/1.0/> 
     PREFIX geo: <http://www.opengis.net/ont/geosparql#> 
@@ -133,8 +145,47 @@ class LinkingResponse:
         return self.linkedClasses + self.linkedRelations + self.linkedEntities
 
 
+class QuestionFeatures:
+    """Question properties the query generator needs, extracted in a single pass over the parsed question."""
+
+    # Bump whenever the extraction changes, so that persisted features are recomputed
+    VERSION = "1"
+
+    def __init__(self, query_form: str, count_applicable: bool, superlative: str = None,
+                 superlative_polarity: float = 0.0, comparative: str = None, comparative_polarity: float = 0.0,
+                 filter_value: float = None, distance: float = None):
+        self.query_form = query_form
+        self.count_applicable = count_applicable
+        self.superlative = superlative
+        self.superlative_polarity = superlative_polarity
+        self.comparative = comparative
+        self.comparative_polarity = comparative_polarity
+        self.filter_value = filter_value
+        self.distance = distance
+
+    def to_dict(self) -> dict:
+        return {
+            "query_form": self.query_form,
+            "count_applicable": self.count_applicable,
+            "superlative": self.superlative,
+            "superlative_polarity": self.superlative_polarity,
+            "comparative": self.comparative,
+            "comparative_polarity": self.comparative_polarity,
+            "filter_value": self.filter_value,
+            "distance": self.distance
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return QuestionFeatures(d["query_form"], d["count_applicable"], d["superlative"], d["superlative_polarity"],
+                                d["comparative"], d["comparative_polarity"], d["filter_value"], d["distance"])
+
+
 class FilledPattern:
-    def __init__(self, query_template, variable, used_classes=None, used_relations=None, used_entities=None):
+    def __init__(self, query_template, variable, used_classes=None, used_relations=None, used_entities=None,
+                 slot_values=None):
+        if slot_values is None:
+            slot_values = {}
         if used_entities is None:
             used_entities = []
         if used_relations is None:
@@ -142,6 +193,7 @@ class FilledPattern:
         if used_classes is None:
             used_classes = []
         self.query_template = query_template
+        self.slot_values = slot_values
         self.variable = variable
         self.used_classes = used_classes
         self.used_relations = used_relations
@@ -171,6 +223,8 @@ class FilledQuery:
         self.used_classes: List[LinkedCandidate] = used_classes
         self.used_relations: List[LinkedCandidate] = used_relations
         self.used_entities: List[LinkedCandidate] = used_entities
+        # Equivalent queries merged into this one by deduplication
+        self.duplicates: List[FilledQuery] = []
 
     def __str__(self) -> str:
         return f"{self.query}"
@@ -178,6 +232,27 @@ class FilledQuery:
     def __repr__(self) -> str:
         return f"{self.query}"
 
+    def get_canonical_form(self) -> str:
+        """Query text with normalized whitespace and a sorted, de-duplicated prefix block."""
+        normalized = re.sub(r"\s+", " ", self.query.strip())
+        prefix_regex = r"PREFIX\s+\S*:\s*<[^>]*>"
+        prefixes = sorted(set(re.findall(prefix_regex, normalized)))
+        body = re.sub(prefix_regex + r"\s*", "", normalized).strip()
+        return " ".join(prefixes + [body])
+
+    def get_canonical_key(self) -> tuple:
+        """Key under which equivalent queries collide. For symmetric operators relating two entities, the entities
+        are masked and kept as a sorted tuple, so that both argument orders share the key."""
+        canonical_form = self.get_canonical_form()
+        if self.geo_operator not in Constants.SYMMETRIC_GEO_OPERATORS or len(self.used_entities) != 2 or \
+                len(self.used_classes) > 0:
+            return canonical_form, ()
+
+        entity_uris = tuple(sorted(set(entity.uri for entity in self.used_entities)))
+        for uri in entity_uris:
+            canonical_form = canonical_form.replace(f"<{uri}>", "<>")
+        return canonical_form, entity_uris
+
     def is_ask_query(self) -> bool:
         return self.query_form == Constants.QUERY_FORM_ASK
 
@@ -1,13 +1,19 @@
+import asyncio
 import re
+import time
+from concurrent.futures import TimeoutError
 from pprint import pprint
 from typing import List
 
 from geoqa import app as flask_app
-from geoqa.core.query_executor import QueryExecutor
+from geoqa.core.query_executor import QueryExecutor, AsyncQueryExecutor
 from geoqa.core.query_generator import QueryGenerator
 from geoqa.model.beans import FilledQuery
-from geoqa.service.rest import ServiceConnector
+from geoqa.service.rest import ServiceConnector, AsyncServiceConnector
 from geoqa.util.ablation_utils import AblationProvider
+from geoqa.util.cache_utils import LRUCache, CacheGeneration
+from geoqa.util.concurrency_utils import WorkerPools, Deadline
+from geoqa.util.metrics_utils import MetricsRegistry, Span, STAGE_SECONDS, QUESTIONS
 from geoqa.util.property_utils import PropertyUtils
 
 ablation_provider = AblationProvider()
@@ -16,47 +22,272 @@ ablation_provider.get_golden_answers()
 class Orchestrator(object):
     LOG = flask_app.logger
     service_connector = ServiceConnector()
+    _answer_cache = None
 
-    def answer_question(self, question: str, lang="en"):
-        cleaned_question = re.sub(r"\s+", " ", question.strip())
+    def __init__(self):
+        # Geo operator of the last question this instance classified, None while unknown or served from cache
+        self.geo_operator = None
+
+    @classmethod
+    def get_answer_cache(cls) -> LRUCache:
+        if cls._answer_cache is None:
+            cls._answer_cache = LRUCache(flask_app.config['ANSWER_CACHE_SIZE'], flask_app.config['ANSWER_CACHE_TTL'])
+        return cls._answer_cache
+
+    @classmethod
+    def invalidate_cache(cls):
+        cls.get_answer_cache().clear()
+        cls.LOG.info("Answer cache invalidated")
+
+    @classmethod
+    def get_answer_cache_key(cls, cleaned_question: str, lang: str) -> tuple:
+        # The ablation flags change what the pipeline answers, so they are part of the key
+        return (cleaned_question, lang, flask_app.config['ABLATION_CLASSIFICATION'],
+                flask_app.config['ABLATION_LINKING'], flask_app.config['ABLATION_RANKING'])
+
+    @classmethod
+    def clean_question(cls, question: str) -> str:
+        return re.sub(r"\s+", " ", question.strip())
+
+    @classmethod
+    def get_geo_operator(cls, classification_response: dict) -> str:
+        classification = classification_response["result"]
+        cls.LOG.info(f"Classification: {classification}")
+        return max(classification, key=classification.get)
+
+    @classmethod
+    def get_empty_answer(cls) -> dict:
+        return {
+            "head": {
+                "vars": ["x"]
+            },
+            "results": {
+                "bindings": []
+            }
+        }
+
+    def answer_question(self, question: str, lang="en", use_cache=True, deadline: Deadline = None):
+        """The best ranked answer. Once the deadline expires, pending candidates are given up and the best answer
+        among those executed so far is returned, without being cached."""
+        deadline = deadline or Deadline()
+        with Span(STAGE_SECONDS, stage="total"):
+            cleaned_question = self.clean_question(question)
+            self.LOG.info(f"Question: {cleaned_question}")
+
+            cache_key = self.get_answer_cache_key(cleaned_question, lang)
+            if use_cache:
+                answer = self.get_answer_cache().get(cache_key)
+                if answer is not None:
+                    self.LOG.info("Answer served from cache")
+                    MetricsRegistry.inc(QUESTIONS, source="cache")
+                    return answer
+
+            queries = self.generate_queries(cleaned_question, deadline)
+
+            with Span(STAGE_SECONDS, stage="query_execution") as span:
+                query_executor = QueryExecutor()
+                results = query_executor.execute_and_rank(queries, deadline)
+            self.LOG.info(f"Timing: query execution and ranking took {span.elapsed:.3f}s")
+
+            MetricsRegistry.inc(QUESTIONS, source="pipeline")
+            return self.select_answer(cleaned_question, cache_key, results, complete=not deadline.is_expired())
+
+    def answer_question_stream(self, question: str, lang="en", use_cache=True, deadline: Deadline = None):
+        """Yields (event, answer) pairs while the candidate queries complete: "provisional" for the first non-empty
+        answer, "update" whenever the best ranked answer changes and "final" once all candidates are ranked. The
+        final answer is the one answer_question returns, golden answer ablation is only applied to it."""
+        deadline = deadline or Deadline()
+        cleaned_question = self.clean_question(question)
         self.LOG.info(f"Question: {cleaned_question}")
 
-        classification = self.service_connector.do_geo_classification(cleaned_question)["result"]
-        geo_operator = max(classification, key=classification.get)
-        self.LOG.info(f"Classification: {classification}")
+        cache_key = self.get_answer_cache_key(cleaned_question, lang)
+        if use_cache:
+            answer = self.get_answer_cache().get(cache_key)
+            if answer is not None:
+                self.LOG.info("Answer served from cache")
+                MetricsRegistry.inc(QUESTIONS, source="cache")
+                yield "final", answer
+                return
+
+        queries = self.generate_queries(cleaned_question, deadline)
+
+        start = time.perf_counter()
+        best = None
+        results = []
+        for final, results in QueryExecutor().execute_and_rank_incrementally(queries, deadline):
+            if final:
+                break
+            if len(results) > 0 and results[0] is not best:
+                yield ("provisional" if best is None else "update"), results[0].result
+                best = results[0]
+        elapsed = time.perf_counter() - start
+        MetricsRegistry.observe(STAGE_SECONDS, elapsed, stage="query_execution")
+        self.LOG.info(f"Timing: query execution and ranking took {elapsed:.3f}s")
+
+        MetricsRegistry.inc(QUESTIONS, source="pipeline")
+        yield "final", self.select_answer(cleaned_question, cache_key, results, complete=not deadline.is_expired())
 
-        linking_info = self.service_connector.do_linking(cleaned_question)
+    def generate_queries(self, cleaned_question: str, deadline: Deadline = None) -> List[FilledQuery]:
+        deadline = deadline or Deadline()
+        # Classification and linking are independent remote calls, so both are in flight at the same time
+        with Span(STAGE_SECONDS, stage="classification_and_linking") as span:
+            pool = WorkerPools.get_pool("services", flask_app.config['SERVICE_CALL_WORKERS'])
+            classification_future = pool.submit(self.service_connector.do_geo_classification, cleaned_question,
+                                                deadline)
+            linking_future = pool.submit(self.service_connector.do_linking, cleaned_question, deadline)
+
+            try:
+                geo_operator = self.get_geo_operator(classification_future.result(timeout=deadline.remaining()))
+                self.geo_operator = geo_operator
+
+                linking_info = linking_future.result(timeout=deadline.remaining())
+            except TimeoutError:
+                raise Exception("Request deadline expired during classification and linking")
         self.LOG.info(f"Linked classes: {linking_info.linkedClasses}")
         self.LOG.info(f"Linked entities: {linking_info.linkedEntities}")
+        self.LOG.info(f"Timing: classification and linking took {span.elapsed:.3f}s")
 
-        query_generator = QueryGenerator(cleaned_question, geo_operator, linking_info)
-        queries: List[FilledQuery] = query_generator.generate_queries()
+        with Span(STAGE_SECONDS, stage="query_generation") as span:
+            query_generator = QueryGenerator(cleaned_question, geo_operator, linking_info, deadline=deadline)
+            queries: List[FilledQuery] = query_generator.generate_queries()
         self.LOG.info(f"Generated queries: {len(queries)}")
+        self.LOG.info(f"Timing: query generation took {span.elapsed:.3f}s")
+
+        return queries
+
+    def answer_questions(self, questions: List[str], lang="en", use_cache=True,
+                         deadline: Deadline = None) -> List[dict]:
+        """Answers several questions at once, in input order.
+
+        The questions are parsed together with nlp.pipe while all their classification and linking calls are in
+        flight, and candidate queries shared between questions are executed only once. A question whose services
+        fail, or do not answer before the deadline, gets an empty answer without failing the others.
+        """
+        deadline = deadline or Deadline()
+        cleaned_questions = [self.clean_question(question) for question in questions]
+        self.LOG.info(f"Questions: {len(cleaned_questions)}")
 
-        query_executor = QueryExecutor()
-        results = query_executor.execute_and_rank(queries)
+        answers = {}
+        pending = []
+        for cleaned_question in dict.fromkeys(cleaned_questions):
+            answer = self.get_answer_cache().get(self.get_answer_cache_key(cleaned_question, lang)) \
+                if use_cache else None
+            if answer is not None:
+                answers[cleaned_question] = answer
+            else:
+                pending.append(cleaned_question)
+        self.LOG.info(f"Answers served from cache: {len(answers)}")
+        MetricsRegistry.inc(QUESTIONS, len(answers), source="cache")
+        MetricsRegistry.inc(QUESTIONS, len(pending), source="pipeline")
 
+        if len(pending) > 0:
+            start = time.perf_counter()
+            pool = WorkerPools.get_pool("services", flask_app.config['SERVICE_CALL_WORKERS'])
+            service_futures = [(pool.submit(self.service_connector.do_geo_classification, cleaned_question, deadline),
+                                pool.submit(self.service_connector.do_linking, cleaned_question, deadline))
+                               for cleaned_question in pending]
+            features = QueryGenerator.get_questions_features(pending)
+
+            query_lists = []
+            for cleaned_question, question_features, (classification_future, linking_future) in \
+                    zip(pending, features, service_futures):
+                try:
+                    geo_operator = self.get_geo_operator(classification_future.result(timeout=deadline.remaining()))
+                    linking_info = linking_future.result(timeout=deadline.remaining())
+                    query_generator = QueryGenerator(cleaned_question, geo_operator, linking_info, question_features,
+                                                     deadline)
+                    query_lists.append(query_generator.generate_queries())
+                except Exception as e:
+                    self.LOG.error(f"Failed to generate queries for {cleaned_question}: {str(e)}")
+                    query_lists.append([])
+            self.LOG.info(f"Generated queries: {sum(len(queries) for queries in query_lists)}")
+            self.LOG.info(f"Timing: parsing, classification, linking and query generation took "
+                          f"{time.perf_counter() - start:.3f}s")
+
+            start = time.perf_counter()
+            ranked = QueryExecutor().execute_and_rank_all(query_lists, deadline)
+            self.LOG.info(f"Timing: query execution and ranking took {time.perf_counter() - start:.3f}s")
+
+            complete = not deadline.is_expired()
+            for cleaned_question, results in zip(pending, ranked):
+                answers[cleaned_question] = self.select_answer(
+                    cleaned_question, self.get_answer_cache_key(cleaned_question, lang), results, complete)
+
+        return [answers[cleaned_question] for cleaned_question in cleaned_questions]
+
+    @classmethod
+    def select_answer(cls, cleaned_question: str, cache_key: tuple, results, complete: bool = True) -> dict:
         if len(results) > 0:
             if flask_app.config["ABLATION_RANKING"]:
                 results = ablation_provider.get_best_answer(cleaned_question, results)
 
-            self.LOG.info(results[0].query.query)
+            cls.LOG.info(results[0].query.query)
+            # Empty answers are not cached, they may stem from transient endpoint failures, and neither are answers
+            # ranked from only part of the candidates
+            if complete:
+                cls.get_answer_cache().put(cache_key, results[0].result)
             return results[0].result
         else:
-            return {
-                "head": {
-                    "vars": ["x"]
-                },
-                "results": {
-                    "bindings": []
-                }
-            }
+            return cls.get_empty_answer()
+
+
+class AsyncOrchestrator(object):
+    """asyncio variant of Orchestrator.answer_question. The service calls and SPARQL queries are awaited on the event
+    loop, while spaCy parsing and query generation, which may block on the geometry lookups, run in the "nlp" pool."""
+    LOG = flask_app.logger
+    service_connector = AsyncServiceConnector()
+
+    async def answer_question(self, question: str, lang="en", use_cache=True, deadline: Deadline = None):
+        deadline = deadline or Deadline()
+        cleaned_question = Orchestrator.clean_question(question)
+        self.LOG.info(f"Question: {cleaned_question}")
+
+        cache_key = Orchestrator.get_answer_cache_key(cleaned_question, lang)
+        if use_cache:
+            answer = Orchestrator.get_answer_cache().get(cache_key)
+            if answer is not None:
+                self.LOG.info("Answer served from cache")
+                MetricsRegistry.inc(QUESTIONS, source="cache")
+                return answer
+
+        with Span(STAGE_SECONDS, stage="classification_and_linking") as span:
+            loop = asyncio.get_running_loop()
+            pool = WorkerPools.get_pool("nlp", flask_app.config['ASYNC_NLP_WORKERS'])
+            services = asyncio.gather(self.service_connector.do_geo_classification(cleaned_question, deadline),
+                                      self.service_connector.do_linking(cleaned_question, deadline))
+            try:
+                features = await loop.run_in_executor(pool, QueryGenerator.get_question_features, cleaned_question)
+                classification, linking_info = await asyncio.wait_for(services, deadline.remaining())
+            except asyncio.TimeoutError:
+                raise Exception("Request deadline expired during classification and linking")
+            finally:
+                # Feature extraction may fail while the service calls are still running
+                services.cancel()
+            geo_operator = Orchestrator.get_geo_operator(classification)
+        self.LOG.info(f"Linked classes: {linking_info.linkedClasses}")
+        self.LOG.info(f"Linked entities: {linking_info.linkedEntities}")
+        self.LOG.info(f"Timing: parsing, classification and linking took {span.elapsed:.3f}s")
+
+        with Span(STAGE_SECONDS, stage="query_generation") as span:
+            query_generator = QueryGenerator(cleaned_question, geo_operator, linking_info, features, deadline)
+            queries: List[FilledQuery] = await loop.run_in_executor(pool, query_generator.generate_queries)
+        self.LOG.info(f"Generated queries: {len(queries)}")
+        self.LOG.info(f"Timing: query generation took {span.elapsed:.3f}s")
+
+        with Span(STAGE_SECONDS, stage="query_execution") as span:
+            results = await AsyncQueryExecutor.execute_and_rank(queries, deadline)
+        self.LOG.info(f"Timing: query execution and ranking took {span.elapsed:.3f}s")
+
+        MetricsRegistry.inc(QUESTIONS, source="pipeline")
+        return Orchestrator.select_answer(cleaned_question, cache_key, results, complete=not deadline.is_expired())
+
 
+MetricsRegistry.register_cache("answer", Orchestrator.get_answer_cache)
+CacheGeneration.register(Orchestrator.invalidate_cache)
 
 
 if __name__ == '__main__':
     o = Orchestrator()
     p = PropertyUtils()
 
-    for q in p.read_benchmark_questions():
-        o.answer_question(q)
+    o.answer_questions(p.read_benchmark_questions())
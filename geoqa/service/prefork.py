@@ -0,0 +1,234 @@
+import gc
+import json
+import os
+import signal
+import socket
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+from geoqa import app as flask_app
+from geoqa.core.local_executor import LocalGeoSparqlEngine
+from geoqa.util.cache_utils import CacheGeneration
+from geoqa.util.http_utils import HttpSessionProvider
+from geoqa.util.nlp_utils import NlpProvider
+
+
+class PreforkServer(object):
+    """Production launcher forking PREFORK_WORKERS worker processes from a warm parent.
+
+    The parent loads the spaCy pipeline and, with the local executor, the knowledge base before forking, so workers
+    share those pages copy-on-write instead of each loading their own copy; the query templates and golden answers
+    are already loaded when geoqa is imported. All workers accept connections on the socket bound by the parent.
+
+    Once every worker is serving, the parent writes PREFORK_READY_FILE with the worker pids, and removes it again on
+    shutdown. SIGHUP replaces the workers one at a time with fresh forks, waiting for each replacement to be ready
+    before the old worker is stopped, so the port keeps being served. SIGTERM and SIGINT stop the workers gracefully,
+    letting them finish in-flight requests for up to PREFORK_GRACEFUL_TIMEOUT seconds. Code changes still need a full
+    restart, as workers are forked from the running parent.
+
+    Every worker has its own in-memory caches. /cache/invalidate reaches all of them through the shared cache
+    generation, see CacheGeneration; SIGUSR1 sent to the parent is forwarded to every worker, which then clears its
+    caches right away, e.g. after the knowledge base was reloaded.
+    """
+    LOG = flask_app.logger
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, host: str = None, port: int = None, workers: int = None):
+        self.host = host if host is not None else flask_app.config['PREFORK_HOST']
+        self.port = port if port is not None else flask_app.config['PREFORK_PORT']
+        self.worker_count = workers if workers is not None else flask_app.config['PREFORK_WORKERS']
+        self.ready_file = flask_app.config['PREFORK_READY_FILE']
+        self.graceful_timeout = flask_app.config['PREFORK_GRACEFUL_TIMEOUT']
+
+        self.listener = None
+        self.ready_pipe = None
+        self.workers = set()
+        self.ready_workers = set()
+        self.stopping = False
+        self.restart_requested = False
+        self.restarting = False
+        self.retiring = set()
+
+    @classmethod
+    def warm_up(cls):
+        start = time.perf_counter()
+        NlpProvider.get_nlp()
+        if flask_app.config['SPARQL_EXECUTOR'] == "local":
+            LocalGeoSparqlEngine.get_instance()
+
+        # Objects that survive until the fork are moved out of the collector's reach, so that collections in the
+        # workers do not write to, and thereby copy, the shared pages
+        gc.collect()
+        gc.freeze()
+        cls.LOG.info(f"Prefork parent warmed up in {time.perf_counter() - start:.1f}s")
+
+    def run(self):
+        self.remove_ready_file()
+        self.warm_up()
+        self.listener = socket.create_server((self.host, self.port), backlog=1024)
+        self.listener.set_inheritable(True)
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        self.ready_pipe = (read_fd, write_fd)
+
+        signal.signal(signal.SIGHUP, self.handle_restart)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGUSR1, self.handle_invalidate)
+
+        self.LOG.info(f"Prefork server listening on {self.host}:{self.port} with {self.worker_count} workers")
+        for _ in range(self.worker_count):
+            self.spawn_worker()
+
+        while not self.stopping:
+            self.reap_workers()
+            self.read_ready_signals()
+            if self.restart_requested:
+                self.restart_requested = False
+                self.rolling_restart()
+            while not self.stopping and len(self.workers) < self.worker_count:
+                self.spawn_worker()
+            time.sleep(self.POLL_INTERVAL)
+
+        self.stop_workers(set(self.workers))
+        self.remove_ready_file()
+        self.listener.close()
+        self.LOG.info("Prefork server stopped")
+
+    def handle_restart(self, signum, frame):
+        self.restart_requested = True
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def handle_invalidate(self, signum, frame):
+        self.LOG.info(f"Forwarding cache invalidation to {len(self.workers)} workers")
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGUSR1)
+            except ProcessLookupError:
+                pass
+
+    def spawn_worker(self) -> int:
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.run_worker()
+            except Exception as e:
+                self.LOG.error(f"Worker {os.getpid()} failed: {str(e)}")
+                os._exit(1)
+            os._exit(0)
+
+        self.workers.add(pid)
+        self.LOG.info(f"Started worker {pid}")
+        return pid
+
+    def run_worker(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # Cleared off the signal handler, as the caches' locks may be held by the interrupted thread
+        signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=CacheGeneration.clear).start())
+        os.close(self.ready_pipe[0])
+
+        server = make_server(self.host, self.port, flask_app, threaded=True, fd=self.listener.fileno())
+        # In-flight requests are joined on server_close instead of being cut off at exit
+        server.daemon_threads = False
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+        parent = os.getppid()
+        threading.Thread(target=self.watch_parent, args=(parent, server), daemon=True).start()
+
+        HttpSessionProvider.get_session()
+        os.write(self.ready_pipe[1], f"{os.getpid()}\n".encode())
+        server.serve_forever()
+        server.server_close()
+
+    @classmethod
+    def watch_parent(cls, parent: int, server):
+        # Workers must not outlive a parent that was killed without stopping them
+        while os.getppid() == parent:
+            time.sleep(1)
+        server.shutdown()
+
+    def read_ready_signals(self):
+        try:
+            data = os.read(self.ready_pipe[0], 65536).decode()
+        except BlockingIOError:
+            data = ""
+
+        for line in data.split():
+            pid = int(line)
+            if pid in self.workers:
+                self.ready_workers.add(pid)
+        if len(self.ready_workers) >= self.worker_count and not self.restarting:
+            self.write_ready_file()
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            if pid in self.workers and pid not in self.retiring and not self.stopping:
+                self.LOG.warning(f"Worker {pid} exited with status {status}, replacing it")
+            self.workers.discard(pid)
+            self.ready_workers.discard(pid)
+            self.retiring.discard(pid)
+
+    def rolling_restart(self):
+        self.LOG.info("Rolling restart of all workers")
+        self.remove_ready_file()
+        self.restarting = True
+        for old_pid in list(self.workers):
+            new_pid = self.spawn_worker()
+            deadline = time.monotonic() + self.graceful_timeout
+            while new_pid not in self.ready_workers and new_pid in self.workers and time.monotonic() < deadline:
+                self.read_ready_signals()
+                self.reap_workers()
+                time.sleep(0.1)
+            self.stop_workers({old_pid})
+            if self.stopping:
+                break
+
+        self.restarting = False
+        self.read_ready_signals()
+
+    def stop_workers(self, pids: set):
+        self.retiring.update(pids)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        deadline = time.monotonic() + self.graceful_timeout
+        while pids & self.workers and time.monotonic() < deadline:
+            self.reap_workers()
+            time.sleep(0.1)
+
+        for pid in pids & self.workers:
+            self.LOG.warning(f"Worker {pid} did not stop in time, killing it")
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+            self.workers.discard(pid)
+            self.ready_workers.discard(pid)
+            self.retiring.discard(pid)
+
+    def write_ready_file(self):
+        if not self.ready_file or os.path.exists(self.ready_file):
+            return
+        with open(self.ready_file, "w") as ready_file:
+            json.dump({"parent": os.getpid(), "workers": sorted(self.ready_workers)}, ready_file)
+        self.LOG.info(f"All {self.worker_count} workers ready")
+
+    def remove_ready_file(self):
+        if self.ready_file and os.path.exists(self.ready_file):
+            os.remove(self.ready_file)
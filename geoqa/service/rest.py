@@ -1,18 +1,41 @@
+import asyncio
 import json
-
-import requests
+import time
+from typing import Optional, Tuple
 
 from geoqa import app as flask_app
 from geoqa.model.beans import LinkingResponse
+from geoqa.util.concurrency_utils import Deadline
+from geoqa.util.fixture_utils import FixtureStore
+from geoqa.util.http_utils import HttpSessionProvider, AsyncHttpSessionProvider
+from geoqa.util.metrics_utils import Span, STAGE_SECONDS
 from geoqa.util.property_utils import PropertyUtils
+from geoqa.util.store_utils import ServiceResponseStore
 
 
 class ServiceConnector(object):
     LOG = flask_app.logger
 
-    def connect(self, service_url: str, params: dict):
+    def connect(self, service_url: str, params: dict, deadline: Deadline = None):
+        if self.is_deadline_expired(service_url, deadline):
+            return None
+        timeout = self.get_timeout(deadline)
+        if FixtureStore.get_mode() is None:
+            return self.connect_to_service(service_url, params, timeout)
+
+        service, key = self.get_fixture_key(service_url, params)
+        if FixtureStore.is_replaying():
+            response, delay = self.get_fixture(service, key)
+            time.sleep(delay)
+            return response
+
+        start = time.perf_counter()
+        return self.record_fixture(service, key, self.connect_to_service(service_url, params, timeout), start)
+
+    def connect_to_service(self, service_url: str, params: dict, timeout: float = None):
         try:
-            response = requests.post(service_url, data=params)
+            response = HttpSessionProvider.get_session().post(service_url, data=params,
+                                                              timeout=HttpSessionProvider.get_timeout(timeout))
 
             if response.status_code == 200:
                 return response.text
@@ -25,12 +48,71 @@ class ServiceConnector(object):
             self.LOG.error(str(ex))
             return None
 
-    def do_linking(self, question) -> LinkingResponse:
+    def connect_with_store(self, service_url: str, params: dict, ablation: bool, deadline: Deadline = None):
+        response = self.get_stored_response(service_url, params, ablation)
+        if response is None:
+            response = self.store_response(service_url, params, ablation,
+                                           self.connect(service_url, params, deadline))
+
+        return response
+
+    @classmethod
+    def is_deadline_expired(cls, service_url: str, deadline: Deadline = None) -> bool:
+        if deadline is not None and deadline.is_expired():
+            cls.LOG.error(f"Request deadline expired before connecting to {service_url}")
+            return True
+        return False
+
+    @classmethod
+    def get_fixture(cls, service: str, key: str) -> Tuple[Optional[str], float]:
+        """Recorded response and the seconds to wait before returning it, no response if none was recorded."""
+        fixture = FixtureStore.get_store().lookup(service, key)
+        if fixture is None:
+            return None, 0.0
+        return fixture[0], FixtureStore.get_replay_delay(fixture[1])
+
+    @classmethod
+    def record_fixture(cls, service: str, key: str, response: Optional[str], start: float) -> Optional[str]:
+        if response is not None:
+            FixtureStore.get_store().record(service, key, response, time.perf_counter() - start)
+        return response
+
+    @classmethod
+    def get_stored_response(cls, service_url: str, params: dict, ablation: bool) -> Optional[str]:
+        # While recording fixtures, every call has to reach the service
+        if FixtureStore.is_recording():
+            return None
+        return ServiceResponseStore.get(service_url, ablation, params["input_text"])
+
+    @classmethod
+    def store_response(cls, service_url: str, params: dict, ablation: bool, response: Optional[str]) -> Optional[str]:
+        if response is not None:
+            ServiceResponseStore.put(service_url, ablation, params["input_text"], response)
+        return response
+
+    @classmethod
+    def get_timeout(cls, deadline: Deadline = None):
+        """Read timeout of a service call, HTTP_READ_TIMEOUT cut to the remaining request budget."""
+        if deadline is None:
+            return None
+        return deadline.get_timeout(flask_app.config['HTTP_READ_TIMEOUT'])
+
+    @classmethod
+    def get_fixture_key(cls, service_url: str, params: dict) -> tuple:
+        services = {PropertyUtils.get_classifier_service_url(): "classify",
+                    PropertyUtils.get_linking_service_url(): "link"}
+        service = services.get(service_url, service_url)
+        return service, FixtureStore.get_key(service, params)
+
+    @classmethod
+    def get_params(cls, question: str, ablation: bool) -> dict:
         params = {"input_text": question}
-        if flask_app.config['ABLATION_LINKING']:
+        if ablation:
             params["ablation"] = True
+        return params
 
-        response = self.connect(PropertyUtils.get_linking_service_url(), params)
+    @classmethod
+    def parse_linking_response(cls, response) -> LinkingResponse:
         if response is None:
             raise Exception("Failed to connect to geo classification service")
         else:
@@ -39,13 +121,83 @@ class ServiceConnector(object):
                                                response_body['linkedRelations'], response_body['linkedEntities'])
             return linking_response
 
-    def do_geo_classification(self, question) -> dict:
-        params = {"input_text": question}
-        if flask_app.config['ABLATION_CLASSIFICATION']:
-            params["ablation"] = True
-
-        response = self.connect(PropertyUtils.get_classifier_service_url(), params)
+    @classmethod
+    def parse_classification_response(cls, response) -> dict:
         if response is None:
             raise Exception("Failed to connect to geo classification service")
         else:
             return json.loads(response)
+
+    def do_linking(self, question, deadline: Deadline = None) -> LinkingResponse:
+        with Span(STAGE_SECONDS, stage="linking"):
+            params = self.get_params(question, flask_app.config['ABLATION_LINKING'])
+            response = self.connect_with_store(PropertyUtils.get_linking_service_url(), params,
+                                               flask_app.config['ABLATION_LINKING'], deadline)
+            return self.parse_linking_response(response)
+
+    def do_geo_classification(self, question, deadline: Deadline = None) -> dict:
+        with Span(STAGE_SECONDS, stage="classification"):
+            params = self.get_params(question, flask_app.config['ABLATION_CLASSIFICATION'])
+            response = self.connect_with_store(PropertyUtils.get_classifier_service_url(), params,
+                                               flask_app.config['ABLATION_CLASSIFICATION'], deadline)
+            return self.parse_classification_response(response)
+
+
+class AsyncServiceConnector(ServiceConnector):
+    """Non-blocking variant of ServiceConnector for the asyncio serving mode. The response store is still queried
+    synchronously, its lookups are local and short."""
+
+    async def connect(self, service_url: str, params: dict, deadline: Deadline = None):
+        if self.is_deadline_expired(service_url, deadline):
+            return None
+        timeout = self.get_timeout(deadline)
+        if FixtureStore.get_mode() is None:
+            return await self.connect_to_service(service_url, params, timeout)
+
+        service, key = self.get_fixture_key(service_url, params)
+        if FixtureStore.is_replaying():
+            response, delay = self.get_fixture(service, key)
+            await asyncio.sleep(delay)
+            return response
+
+        start = time.perf_counter()
+        return self.record_fixture(service, key, await self.connect_to_service(service_url, params, timeout), start)
+
+    async def connect_to_service(self, service_url: str, params: dict, timeout: float = None):
+        try:
+            # Form values are sent as strings, as requests does
+            status, text = await AsyncHttpSessionProvider.post(service_url, {k: str(v) for k, v in params.items()},
+                                                               read_timeout=timeout)
+
+            if status == 200:
+                return text
+            else:
+                self.LOG.error(f"Problem in connecting to {service_url}")
+                self.LOG.error(f"Response status code: {status}")
+                return None
+        except Exception as ex:
+            self.LOG.error(f"Failed to connect to {service_url}")
+            self.LOG.error(str(ex))
+            return None
+
+    async def connect_with_store(self, service_url: str, params: dict, ablation: bool, deadline: Deadline = None):
+        response = self.get_stored_response(service_url, params, ablation)
+        if response is None:
+            response = self.store_response(service_url, params, ablation,
+                                           await self.connect(service_url, params, deadline))
+
+        return response
+
+    async def do_linking(self, question, deadline: Deadline = None) -> LinkingResponse:
+        with Span(STAGE_SECONDS, stage="linking"):
+            params = self.get_params(question, flask_app.config['ABLATION_LINKING'])
+            response = await self.connect_with_store(PropertyUtils.get_linking_service_url(), params,
+                                                     flask_app.config['ABLATION_LINKING'], deadline)
+            return self.parse_linking_response(response)
+
+    async def do_geo_classification(self, question, deadline: Deadline = None) -> dict:
+        with Span(STAGE_SECONDS, stage="classification"):
+            params = self.get_params(question, flask_app.config['ABLATION_CLASSIFICATION'])
+            response = await self.connect_with_store(PropertyUtils.get_classifier_service_url(), params,
+                                                     flask_app.config['ABLATION_CLASSIFICATION'], deadline)
+            return self.parse_classification_response(response)
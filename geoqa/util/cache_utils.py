@@ -0,0 +1,131 @@
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from geoqa import app as flask_app
+
+
+class LRUCache(object):
+    """Thread safe least-recently-used cache whose entries additionally expire after ttl seconds."""
+
+    _MISSING = object()
+
+    def __init__(self, max_size: int, ttl: float = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, self._MISSING)
+            if entry is not self._MISSING:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+class CacheGeneration(object):
+    """Generation of the in-memory caches, shared by all processes through the CACHE_GENERATION_PATH file.
+
+    Invalidation bumps the generation, and every process clears its registered caches the next time it calls
+    refresh and finds a generation other than the one it last saw; the serving endpoints call it per request.
+    Without CACHE_GENERATION_PATH invalidation only reaches the process it is requested from.
+    """
+    LOG = flask_app.logger
+    _invalidators = []
+    _seen = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def register(cls, invalidate: Callable[[], None]):
+        cls._invalidators.append(invalidate)
+
+    @classmethod
+    def read(cls) -> int:
+        path = flask_app.config['CACHE_GENERATION_PATH']
+        try:
+            with open(path) as generation_file:
+                return int(generation_file.read().strip() or 0)
+        except (OSError, TypeError, ValueError):
+            return 0
+
+    @classmethod
+    def refresh(cls):
+        if flask_app.config['CACHE_GENERATION_PATH'] is None:
+            return
+        generation = cls.read()
+        with cls._lock:
+            if cls._seen is None:
+                cls._seen = generation
+            elif generation != cls._seen:
+                cls._seen = generation
+                cls.LOG.info(f"Cache generation {generation}, clearing the caches of process {os.getpid()}")
+                cls.clear()
+
+    @classmethod
+    def invalidate(cls):
+        """Clears the caches of this process and bumps the generation, so that the other processes clear theirs."""
+        path = flask_app.config['CACHE_GENERATION_PATH']
+        with cls._lock:
+            if path is not None:
+                cls._seen = cls.read() + 1
+                # Replaced atomically, so that readers never see a partially written number
+                with open(f"{path}.{os.getpid()}", "w") as generation_file:
+                    generation_file.write(str(cls._seen))
+                os.replace(f"{path}.{os.getpid()}", path)
+            cls.clear()
+
+    @classmethod
+    def clear(cls):
+        for invalidate in cls._invalidators:
+            invalidate()
+
+    @classmethod
+    def is_authorized(cls, token: Optional[str], remote_address: Optional[str]) -> bool:
+        """Whether a client may invalidate the caches: with CACHE_INVALIDATION_TOKEN set, the token must match it,
+        otherwise only local clients may."""
+        expected = flask_app.config['CACHE_INVALIDATION_TOKEN']
+        if expected is None:
+            return remote_address in ("127.0.0.1", "::1")
+        return token is not None and hmac.compare_digest(token.encode(), expected.encode())
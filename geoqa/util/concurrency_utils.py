@@ -0,0 +1,100 @@
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from geoqa import app as flask_app
+
+
+class AttributedThreadPoolExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor remembering which request thread each running task was submitted for, see
+    WorkerPools.get_owner."""
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(WorkerPools.run_for, WorkerPools.get_owner(threading.get_ident()), fn, *args, **kwargs)
+
+
+class WorkerPools(object):
+    _pools = {}
+    _pid = None
+    _lock = threading.Lock()
+    # Pool thread ident -> ident of the thread its current task runs for
+    _owners = {}
+
+    @classmethod
+    def get_pool(cls, name: str, max_workers: int) -> ThreadPoolExecutor:
+        """Returns the shared thread pool registered under name, creating it on first use.
+
+        Pools are bound to the process that created them, so a forked worker never reuses the (thread-less) pools
+        inherited from its parent.
+        """
+        with cls._lock:
+            if cls._pid != os.getpid():
+                cls._pools = {}
+                cls._owners = {}
+                cls._pid = os.getpid()
+
+            pool = cls._pools.get(name)
+            if pool is None:
+                pool = AttributedThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+                cls._pools[name] = pool
+
+            return pool
+
+    @classmethod
+    def get_owner(cls, thread_id: int) -> int:
+        """Thread a pool thread currently runs a task for, following tasks submitted from pool tasks back to the
+        thread that submitted the first one. The thread itself if it does not run a pool task."""
+        return cls._owners.get(thread_id, thread_id)
+
+    @classmethod
+    def run_for(cls, owner: int, fn, *args, **kwargs):
+        thread_id = threading.get_ident()
+        cls._owners[thread_id] = owner
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            cls._owners.pop(thread_id, None)
+
+    @classmethod
+    def is_pool_thread(cls, thread: threading.Thread) -> bool:
+        # ThreadPoolExecutor names its threads <thread_name_prefix>_<n>
+        return thread.name.rpartition("_")[0] in cls._pools
+
+
+class Deadline(object):
+    """Time budget of a request, shared by all its stages. A deadline without budget never expires."""
+
+    def __init__(self, budget: Optional[float] = None):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget if budget is not None else None
+
+    @classmethod
+    def for_request(cls, requested: Optional[str] = None) -> "Deadline":
+        """Deadline of REQUEST_TIME_BUDGET seconds, or of the budget the client asked for, up to
+        REQUEST_MAX_TIME_BUDGET. Budgets that are not a positive number are ignored."""
+        budget = flask_app.config['REQUEST_TIME_BUDGET']
+        if requested:
+            try:
+                requested_budget = float(requested)
+                if math.isfinite(requested_budget) and requested_budget > 0:
+                    budget = min(requested_budget, flask_app.config['REQUEST_MAX_TIME_BUDGET'])
+            except ValueError:
+                pass
+        return Deadline(budget)
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left, None without budget."""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def is_expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def get_timeout(self, timeout: float) -> float:
+        """The timeout, cut to the remaining budget. It is never cut to 0, which disables the timeout of aiohttp."""
+        remaining = self.remaining()
+        return timeout if remaining is None else max(min(timeout, remaining), 0.001)
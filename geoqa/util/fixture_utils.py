@@ -0,0 +1,90 @@
+import atexit
+import gzip
+import json
+import os
+import threading
+from typing import Optional, Tuple
+
+from geoqa import app as flask_app
+
+
+class FixtureStore(object):
+    """Recorded classifier, linker and SPARQL responses, keyed by service and normalized input.
+
+    With FIXTURE_MODE "record", ServiceConnector.connect and QueryExecutor.execute add every successful exchange, with
+    its latency, to the store at FIXTURE_PATH, which is written when the process exits. With "replay" they answer from
+    the store without any network I/O, waiting the recorded latency times FIXTURE_LATENCY_SCALE; unrecorded requests
+    fail like an unreachable service. The file is gzipped JSON lines, one exchange per line. Recording is meant for a
+    single process, concurrent recorders of the same file overwrite each other.
+    """
+    LOG = flask_app.logger
+    _store = None
+    _lock = threading.Lock()
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fixtures = {}
+        self.misses = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with gzip.open(path, "rt", encoding="utf-8") as fixture_file:
+                for line in fixture_file:
+                    fixture = json.loads(line)
+                    self.fixtures[(fixture["service"], fixture["key"])] = (fixture["response"], fixture["latency"])
+
+    @classmethod
+    def get_mode(cls) -> Optional[str]:
+        return flask_app.config['FIXTURE_MODE']
+
+    @classmethod
+    def is_recording(cls) -> bool:
+        return cls.get_mode() == "record"
+
+    @classmethod
+    def is_replaying(cls) -> bool:
+        return cls.get_mode() == "replay"
+
+    @classmethod
+    def get_store(cls) -> "FixtureStore":
+        with cls._lock:
+            if cls._store is None or cls._store.path != flask_app.config['FIXTURE_PATH']:
+                cls._store = FixtureStore(flask_app.config['FIXTURE_PATH'])
+                atexit.register(cls._store.save_if_recording)
+            return cls._store
+
+    @classmethod
+    def get_key(cls, service: str, payload: dict) -> str:
+        if service == "sparql":
+            return " ".join(payload.get("query", "").split())
+        # Form values travel as strings, so in-process and HTTP requests map to the same key
+        return json.dumps({name: str(value) for name, value in payload.items()}, sort_keys=True)
+
+    @classmethod
+    def get_replay_delay(cls, latency: float) -> float:
+        return latency * flask_app.config['FIXTURE_LATENCY_SCALE']
+
+    def lookup(self, service: str, key: str) -> Optional[Tuple[str, float]]:
+        """The recorded response and its latency in seconds, None if the request was not recorded."""
+        fixture = self.fixtures.get((service, key))
+        if fixture is None:
+            with self._lock:
+                self.misses += 1
+            self.LOG.warning(f"No {service} fixture for {key}")
+        return fixture
+
+    def record(self, service: str, key: str, response: str, latency: float):
+        with self._lock:
+            self.fixtures[(service, key)] = (response, round(latency, 4))
+
+    def save(self):
+        with self._lock:
+            fixtures = sorted(self.fixtures.items())
+        with gzip.open(self.path, "wt", encoding="utf-8") as fixture_file:
+            for (service, key), (response, latency) in fixtures:
+                fixture_file.write(json.dumps({"service": service, "key": key, "response": response,
+                                               "latency": latency}) + "\n")
+        self.LOG.info(f"Saved {len(fixtures)} fixtures to {self.path}")
+
+    def save_if_recording(self):
+        if self.is_recording() and len(self.fixtures) > 0:
+            self.save()
@@ -0,0 +1,124 @@
+import asyncio
+import os
+import random
+import threading
+from typing import Tuple
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from geoqa import app as flask_app
+
+
+class JitteredRetry(Retry):
+    """Retry policy with full jitter, so that workers retrying after the same failure do not hit a service in
+    lockstep."""
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff) if backoff > 0 else 0
+
+
+class HttpSessionProvider(object):
+    _session = None
+    _pid = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_session(cls) -> requests.Session:
+        """Returns the process wide keep-alive session used for the REST services and the SPARQL endpoint."""
+        with cls._lock:
+            if cls._session is None or cls._pid != os.getpid():
+                cls._session = cls.create_session()
+                cls._pid = os.getpid()
+
+            return cls._session
+
+    @classmethod
+    def create_session(cls) -> requests.Session:
+        retry = JitteredRetry(total=flask_app.config['HTTP_MAX_RETRIES'],
+                              backoff_factor=flask_app.config['HTTP_BACKOFF_FACTOR'],
+                              status_forcelist=(502, 503, 504),
+                              # A read timeout used up the time the call was given, retrying would overrun the
+                              # request deadline
+                              read=0,
+                              # All outbound calls are read-only, so retrying a POST is safe
+                              allowed_methods=frozenset(["GET", "POST"]),
+                              raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=flask_app.config['HTTP_POOL_CONNECTIONS'],
+                              pool_maxsize=flask_app.config['HTTP_POOL_SIZE'],
+                              max_retries=retry)
+
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    @classmethod
+    def get_timeout(cls, read_timeout: float = None) -> tuple:
+        if read_timeout is None:
+            read_timeout = flask_app.config['HTTP_READ_TIMEOUT']
+        return min(flask_app.config['HTTP_CONNECT_TIMEOUT'], read_timeout), read_timeout
+
+
+class AsyncHttpSessionProvider(object):
+    """aiohttp counterpart of HttpSessionProvider for the asyncio serving mode, with one session per event loop."""
+    RETRY_STATUSES = (502, 503, 504)
+    _sessions = {}
+
+    @classmethod
+    def get_session(cls) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        session = cls._sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=flask_app.config['ASYNC_HTTP_CONNECTION_LIMIT'],
+                                             limit_per_host=flask_app.config['ASYNC_HTTP_CONNECTION_LIMIT'])
+            session = aiohttp.ClientSession(connector=connector)
+            cls._sessions[loop] = session
+
+        return session
+
+    @classmethod
+    async def close(cls):
+        session = cls._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    @classmethod
+    def get_timeout(cls, read_timeout: float = None) -> aiohttp.ClientTimeout:
+        if read_timeout is None:
+            read_timeout = flask_app.config['HTTP_READ_TIMEOUT']
+        return aiohttp.ClientTimeout(sock_connect=min(flask_app.config['HTTP_CONNECT_TIMEOUT'], read_timeout),
+                                     sock_read=read_timeout)
+
+    @classmethod
+    def is_retryable(cls, error: aiohttp.ClientConnectionError) -> bool:
+        """Connection errors and connect timeouts are retried, read timeouts are not, as in the synchronous session.
+        Before aiohttp 3.10 both timeouts are raised as ServerTimeoutError and only their message tells them apart."""
+        if not isinstance(error, asyncio.TimeoutError):
+            return True
+        connect_timeout_error = getattr(aiohttp, "ConnectionTimeoutError", ())
+        return isinstance(error, connect_timeout_error) or str(error).startswith("Connection timeout")
+
+    @classmethod
+    async def post(cls, url: str, data: dict, headers: dict = None, read_timeout: float = None) -> Tuple[int, str]:
+        """POSTs with the retry policy of the synchronous session: connection errors, connect timeouts and
+        502/503/504 are retried up to HTTP_MAX_RETRIES times with jittered exponential backoff. Returns the last
+        status code and body."""
+        max_retries = flask_app.config['HTTP_MAX_RETRIES']
+        for attempt in range(max_retries + 1):
+            try:
+                async with cls.get_session().post(url, data=data, headers=headers,
+                                                  timeout=cls.get_timeout(read_timeout)) as response:
+                    text = await response.text()
+                    if response.status not in cls.RETRY_STATUSES or attempt == max_retries:
+                        return response.status, text
+            except aiohttp.ClientConnectionError as e:
+                if attempt == max_retries or not cls.is_retryable(e):
+                    raise
+
+            if attempt > 0:
+                backoff = flask_app.config['HTTP_BACKOFF_FACTOR'] * (2 ** attempt)
+                await asyncio.sleep(random.uniform(0, backoff))
@@ -0,0 +1,192 @@
+import bisect
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from geoqa import app as flask_app
+from geoqa.util.cache_utils import LRUCache
+
+# Latencies from a cached lookup (sub-millisecond) up to an abandoned SPARQL query
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(label_names: Tuple[str, ...], label_values: tuple, extra: str = None) -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(label_names, label_values)]
+    if extra is not None:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+
+class Counter(object):
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        # Per label values: non-cumulative bucket counts (the last one is +Inf), sum and count
+        self._series: Dict[tuple, list] = {}
+        # Raw observations per label values while recording, for exact percentiles in benchmarks
+        self._samples: Optional[Dict[tuple, List[float]]] = None
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._series[key] = series
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+            if self._samples is not None:
+                self._samples.setdefault(key, []).append(value)
+
+    def start_recording(self):
+        with self._lock:
+            self._samples = {}
+
+    def stop_recording(self) -> Dict[tuple, List[float]]:
+        with self._lock:
+            samples, self._samples = self._samples or {}, None
+            return samples
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{format_labels(self.label_names, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.label_names, key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.label_names, key)} {count}")
+        return lines
+
+
+class Span(object):
+    """Times a block into a histogram, e.g. `with Span(STAGE_SECONDS, stage="linking") as span:`. The elapsed
+    seconds stay available as span.elapsed, also when the block raised."""
+
+    def __init__(self, histogram: Histogram, **labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.perf_counter() - self.start
+        if MetricsRegistry.is_enabled():
+            self.histogram.observe(self.elapsed, **self.labels)
+        return False
+
+
+class MetricsRegistry(object):
+    """Process wide metrics, rendered in the Prometheus text format at /metrics.
+
+    Metrics are kept per process: behind the pre-forking launcher every worker reports its own values, so each
+    worker needs to be scraped on its own for totals.
+    """
+    _metrics: Dict[str, object] = {}
+    _caches: Dict[str, Callable[[], LRUCache]] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        return flask_app.config['METRICS_ENABLED']
+
+    @classmethod
+    def counter(cls, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        with cls._lock:
+            if name not in cls._metrics:
+                cls._metrics[name] = Counter(name, documentation, label_names)
+            return cls._metrics[name]
+
+    @classmethod
+    def histogram(cls, name: str, documentation: str, label_names: Tuple[str, ...] = (),
+                  buckets=DEFAULT_BUCKETS) -> Histogram:
+        with cls._lock:
+            if name not in cls._metrics:
+                cls._metrics[name] = Histogram(name, documentation, label_names, buckets)
+            return cls._metrics[name]
+
+    @classmethod
+    def register_cache(cls, name: str, get_cache: Callable[[], LRUCache]):
+        """Exposes the hit, miss and eviction counts of an LRUCache, read from its statistics at scrape time."""
+        with cls._lock:
+            cls._caches[name] = get_cache
+
+    @classmethod
+    def render_caches(cls, caches: Dict[str, Callable[[], LRUCache]]) -> List[str]:
+        stats = {name: get_cache().stats() for name, get_cache in sorted(caches.items())}
+        lines = []
+        for stat, metric_type in (("hits", "counter"), ("misses", "counter"), ("evictions", "counter"),
+                                  ("size", "gauge")):
+            name = f"geoqa_cache_{stat}_total" if metric_type == "counter" else f"geoqa_cache_{stat}"
+            lines.append(f"# HELP {name} Cache {stat} per cache")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for cache, cache_stats in stats.items():
+                lines.append(f'{name}{{cache="{cache}"}} {cache_stats[stat]}')
+        return lines
+
+    @classmethod
+    def inc(cls, counter: Counter, amount: float = 1, **labels):
+        if cls.is_enabled():
+            counter.inc(amount, **labels)
+
+    @classmethod
+    def observe(cls, histogram: Histogram, value: float, **labels):
+        if cls.is_enabled():
+            histogram.observe(value, **labels)
+
+    @classmethod
+    def render(cls) -> str:
+        with cls._lock:
+            metrics = list(cls._metrics.values())
+            caches = dict(cls._caches)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        if len(caches) > 0:
+            lines.extend(cls.render_caches(caches))
+        return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = MetricsRegistry.histogram("geoqa_stage_seconds", "Duration of the question answering stages",
+                                          ("stage",))
+SPARQL_EXECUTE_SECONDS = MetricsRegistry.histogram("geoqa_sparql_execute_seconds",
+                                                   "Duration of single SPARQL query executions", ("source",))
+CANDIDATES_GENERATED = MetricsRegistry.counter("geoqa_candidates_generated_total", "Candidate queries generated")
+CANDIDATES_FILTERED = MetricsRegistry.counter("geoqa_candidates_filtered_total",
+                                              "Candidate queries dropped before execution", ("reason",))
+EMPTY_RESULTS = MetricsRegistry.counter("geoqa_empty_results_total",
+                                        "Executed candidate queries without an answer")
+QUESTIONS = MetricsRegistry.counter("geoqa_questions_total", "Questions answered", ("source",))
@@ -0,0 +1,78 @@
+import json
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+from geoqa import app as flask_app
+
+
+class NlpProvider(object):
+    """Loads the spaCy pipeline on first use instead of at import time, without the components the query generator
+    never reads.
+
+    The generator only needs tags, lemmas and the spacytextblob polarity, so components listed in
+    SPACY_EXCLUDED_COMPONENTS are not even loaded from the model package.
+    """
+    LOG = flask_app.logger
+    _nlp = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_nlp(cls):
+        if cls._nlp is None:
+            with cls._lock:
+                if cls._nlp is None:
+                    cls._nlp = cls.load(flask_app.config['SPACY_MODEL'],
+                                        flask_app.config['SPACY_EXCLUDED_COMPONENTS'])
+
+        return cls._nlp
+
+    @classmethod
+    def get_model_name(cls) -> str:
+        return flask_app.config['SPACY_MODEL']
+
+    @classmethod
+    def load(cls, model: str, excluded_components):
+        import spacy
+        from spacytextblob.spacytextblob import SpacyTextBlob  # noqa: F401 registers the spacytextblob factory
+
+        start = time.perf_counter()
+        nlp = spacy.load(model, exclude=list(excluded_components))
+        nlp.add_pipe('spacytextblob')
+        cls.LOG.info(f"Loaded spaCy model {model} with {nlp.pipe_names} in {time.perf_counter() - start:.2f}s")
+        return nlp
+
+
+def get_max_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure_load(excluded_components) -> dict:
+    rss_before = get_max_rss_mb()
+    start = time.perf_counter()
+    nlp = NlpProvider.load(flask_app.config['SPACY_MODEL'], excluded_components)
+    return {
+        "excluded": list(excluded_components),
+        "components": nlp.pipe_names,
+        "load_seconds": round(time.perf_counter() - start, 3),
+        "rss_increase_mb": round(get_max_rss_mb() - rss_before, 1)
+    }
+
+
+if __name__ == '__main__':
+    # Each variant is measured in a fresh interpreter, as the maximum RSS of a process never goes down
+    if len(sys.argv) > 1:
+        print(json.dumps(measure_load(json.loads(sys.argv[1]))))
+    else:
+        for excluded in ([], flask_app.config['SPACY_EXCLUDED_COMPONENTS']):
+            process = subprocess.run([sys.executable, "-m", "geoqa.util.nlp_utils", json.dumps(excluded)],
+                                     capture_output=True, text=True)
+            if process.returncode != 0:
+                # e.g. the model package is not installed
+                error = process.stderr.strip().splitlines()
+                sys.exit(f"Failed to load {flask_app.config['SPACY_MODEL']} without {excluded}: "
+                         f"{error[-1] if len(error) > 0 else process.returncode}")
+            print(process.stdout.strip().splitlines()[-1])
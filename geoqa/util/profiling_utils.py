@@ -0,0 +1,170 @@
+import cProfile
+import glob
+import hmac
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+from geoqa import app as flask_app
+from geoqa.util.concurrency_utils import WorkerPools
+
+MODES = ("cprofile", "sampling")
+
+
+class StackSampler(threading.Thread):
+    """Samples the stacks of a request thread and of the worker pool threads running tasks submitted for it every
+    interval seconds, counting them as collapsed stacks (root first, frames separated by ";"). Pool threads working
+    for other requests are left out."""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="profiler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    @classmethod
+    def get_frame_name(cls, frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def sample(self):
+        frames = sys._current_frames()
+        thread_names = {self.thread_id: "request"}
+        for thread in threading.enumerate():
+            if WorkerPools.is_pool_thread(thread) and WorkerPools.get_owner(thread.ident) == self.thread_id:
+                thread_names[thread.ident] = thread.name
+
+        for thread_id, thread_name in thread_names.items():
+            frame = frames.get(thread_id)
+            names = []
+            while frame is not None:
+                names.append(self.get_frame_name(frame))
+                frame = frame.f_back
+            self.stacks[";".join([thread_name] + names[::-1])] += 1
+
+
+class RequestProfiler(object):
+    """Opt-in profiling of single requests.
+
+    A request is profiled when sampled at PROFILING_SAMPLE_RATE, or, with PROFILING_ON_REQUEST, when it asks for it
+    with the X-GeoQA-Profile header or the profile parameter ("1", "true", "cprofile" or "sampling") and sends
+    PROFILING_TOKEN in the X-GeoQA-Profile-Token header; without a token configured, requests cannot ask. "cprofile"
+    profiles the request thread deterministically and writes pstats (python -m pstats, snakeviz); work handed to the
+    worker pools shows up as the wait for it. "sampling" samples the request thread and the busy pool threads every
+    PROFILING_SAMPLE_INTERVAL seconds and writes collapsed stacks (flamegraph.pl, speedscope), rooted at the geo
+    operator. Dumps go to PROFILING_OUTPUT_DIR, tagged with the question and geo operator in their name and in
+    index.jsonl, of which the latest PROFILING_MAX_DUMPS are kept. Requests that are not profiled pay for one random
+    draw.
+    """
+    LOG = flask_app.logger
+    _sequence = itertools.count()
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.profile = None
+        self.sampler = None
+        self.start_time = None
+        self.elapsed = 0.0
+
+    @classmethod
+    def get_requested_mode(cls, requested: Optional[str], token: Optional[str] = None) -> Optional[str]:
+        if requested is None or not flask_app.config['PROFILING_ON_REQUEST'] or not cls.is_authorized(token):
+            return None
+        requested = requested.strip().lower()
+        if requested in MODES:
+            return requested
+        if requested in ("1", "true", "yes"):
+            return flask_app.config['PROFILING_MODE']
+        return None
+
+    @classmethod
+    def is_authorized(cls, token: Optional[str]) -> bool:
+        expected = flask_app.config['PROFILING_TOKEN']
+        return expected is not None and token is not None and hmac.compare_digest(token.encode(), expected.encode())
+
+    @classmethod
+    def for_request(cls, requested: Optional[str] = None, token: Optional[str] = None) -> Optional["RequestProfiler"]:
+        """A profiler if the request is to be profiled, None otherwise."""
+        mode = cls.get_requested_mode(requested, token)
+        if mode is None and random.random() < flask_app.config['PROFILING_SAMPLE_RATE']:
+            mode = flask_app.config['PROFILING_MODE']
+        return RequestProfiler(mode) if mode is not None else None
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        if self.mode == "cprofile":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.sampler = StackSampler(threading.get_ident(), flask_app.config['PROFILING_SAMPLE_INTERVAL'])
+            self.sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profile is not None:
+            self.profile.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+        self.elapsed = time.perf_counter() - self.start_time
+        return False
+
+    def dump(self, question: str, geo_operator: Optional[str]) -> Optional[str]:
+        """Writes the profile tagged with the question and geo operator, returns its path."""
+        output_dir = flask_app.config['PROFILING_OUTPUT_DIR']
+        geo_operator = geo_operator or "none"
+        slug = re.sub(r"[^A-Za-z0-9]+", "-", question or "").strip("-")[:48]
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self._sequence)}-{geo_operator}-{slug}"
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            if self.mode == "cprofile":
+                path = os.path.join(output_dir, f"{name}.pstats")
+                self.profile.dump_stats(path)
+            else:
+                path = os.path.join(output_dir, f"{name}.folded")
+                with open(path, "w") as profile_file:
+                    for stack, count in sorted(self.sampler.stacks.items()):
+                        profile_file.write(f"{geo_operator};{stack} {count}\n")
+
+            with open(os.path.join(output_dir, "index.jsonl"), "a") as index_file:
+                index_file.write(json.dumps({"file": os.path.basename(path), "mode": self.mode, "question": question,
+                                             "geo_operator": geo_operator, "seconds": round(self.elapsed, 4)}) + "\n")
+            self.rotate(output_dir)
+        except OSError as e:
+            self.LOG.error(f"Failed to write profile {name}: {str(e)}")
+            return None
+
+        self.LOG.info(f"Profiled request in {self.elapsed:.3f}s, written to {path}")
+        return path
+
+    @classmethod
+    def rotate(cls, output_dir: str):
+        """Deletes all but the latest PROFILING_MAX_DUMPS dumps and their index entries."""
+        dumps = glob.glob(os.path.join(output_dir, "*.pstats")) + glob.glob(os.path.join(output_dir, "*.folded"))
+        if len(dumps) <= flask_app.config['PROFILING_MAX_DUMPS']:
+            return
+
+        dumps.sort(key=os.path.getmtime)
+        for path in dumps[:len(dumps) - flask_app.config['PROFILING_MAX_DUMPS']]:
+            os.remove(path)
+        index_path = os.path.join(output_dir, "index.jsonl")
+        with open(index_path) as index_file:
+            entries = [line for line in index_file
+                       if os.path.exists(os.path.join(output_dir, json.loads(line)["file"]))]
+        with open(index_path, "w") as index_file:
+            index_file.writelines(entries)
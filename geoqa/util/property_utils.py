@@ -45,9 +45,13 @@ class PropertyUtils(object):
         return questions_list
 
     @classmethod
-    def get_query_templates(cls, geo_operator: str) -> dict:
+    def get_all_query_templates(cls) -> dict:
         if cls.__QUERY_TEMPLATES is None:
             with open_text(geoqa, "query_templates.yml") as o:
                 cls.__QUERY_TEMPLATES = yaml.load(o, Loader=yaml.FullLoader)
 
-        return cls.__QUERY_TEMPLATES[geo_operator]
+        return cls.__QUERY_TEMPLATES
+
+    @classmethod
+    def get_query_templates(cls, geo_operator: str) -> dict:
+        return cls.get_all_query_templates()[geo_operator]
@@ -0,0 +1,66 @@
+import os
+import sqlite3
+import threading
+import time
+
+from geoqa import app as flask_app
+
+
+class ServiceResponseStore(object):
+    """On-disk store of raw classifier and linker responses, shared by all worker processes of a host.
+
+    Entries are keyed by service url, ablation flag, SERVICE_CACHE_VERSION and question. SQLite in WAL mode lets
+    several processes read concurrently while one writes; each thread of each process uses its own connection.
+    """
+    LOG = flask_app.logger
+    _local = threading.local()
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        return bool(flask_app.config['SERVICE_CACHE_PATH'])
+
+    @classmethod
+    def get_connection(cls) -> sqlite3.Connection:
+        connection = getattr(cls._local, "connection", None)
+        if connection is None or cls._local.pid != os.getpid():
+            connection = sqlite3.connect(flask_app.config['SERVICE_CACHE_PATH'], timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS service_responses ("
+                               "service_url TEXT NOT NULL, ablation INTEGER NOT NULL, version TEXT NOT NULL, "
+                               "question TEXT NOT NULL, response TEXT NOT NULL, created_at REAL NOT NULL, "
+                               "PRIMARY KEY (service_url, ablation, version, question))")
+            connection.commit()
+            cls._local.connection = connection
+            cls._local.pid = os.getpid()
+
+        return connection
+
+    @classmethod
+    def get(cls, service_url: str, ablation: bool, question: str):
+        if not cls.is_enabled():
+            return None
+
+        try:
+            row = cls.get_connection().execute(
+                "SELECT response FROM service_responses "
+                "WHERE service_url = ? AND ablation = ? AND version = ? AND question = ?",
+                (service_url, int(ablation), flask_app.config['SERVICE_CACHE_VERSION'], question)).fetchone()
+            return row[0] if row is not None else None
+        except sqlite3.Error as e:
+            cls.LOG.error(f"Service response store lookup failed: {str(e)}")
+            return None
+
+    @classmethod
+    def put(cls, service_url: str, ablation: bool, question: str, response: str):
+        if not cls.is_enabled():
+            return
+
+        try:
+            connection = cls.get_connection()
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO service_responses VALUES (?, ?, ?, ?, ?, ?)",
+                    (service_url, int(ablation), flask_app.config['SERVICE_CACHE_VERSION'], question, response,
+                     time.time()))
+        except sqlite3.Error as e:
+            cls.LOG.error(f"Service response store write failed: {str(e)}")
@@ -1,11 +1,22 @@
-from flask import render_template, request, jsonify
+import json
+
+from flask import render_template, request, jsonify, Response, stream_with_context
 
 from geoqa import app
 from geoqa.service.orchestration import Orchestrator
+from geoqa.util.cache_utils import CacheGeneration
+from geoqa.util.concurrency_utils import Deadline
+from geoqa.util.metrics_utils import MetricsRegistry
+from geoqa.util.profiling_utils import RequestProfiler
 
 from geoqa import app as flask_app
 
 
+@app.before_request
+def refresh_caches():
+    CacheGeneration.refresh()
+
+
 @app.route("/")
 def index():
     qa()
@@ -18,14 +29,32 @@ def qa():
         if request.method == "POST":
             query = request.form.get('query')
             lang = request.form.get('lang', 'en')
+            no_cache = request.form.get('no_cache', 'false')
+            profile = request.form.get('profile')
+            time_budget = request.form.get('time_budget')
         else:
             query = request.args.get('query')
             lang = request.args.get('lang', 'en')
+            no_cache = request.args.get('no_cache', 'false')
+            profile = request.args.get('profile')
+            time_budget = request.args.get('time_budget')
+        deadline = Deadline.for_request(time_budget)
 
         flask_app.logger.info(f"{request.method} /qa {query}")
 
         orchestration_service = Orchestrator()
-        answer = orchestration_service.answer_question(query, lang)
+        profiler = RequestProfiler.for_request(request.headers.get('X-GeoQA-Profile', profile),
+                                               request.headers.get('X-GeoQA-Profile-Token'))
+        if profiler is None:
+            answer = orchestration_service.answer_question(query, lang, use_cache=no_cache.lower() != "true",
+                                                           deadline=deadline)
+        else:
+            try:
+                with profiler:
+                    answer = orchestration_service.answer_question(query, lang, use_cache=no_cache.lower() != "true",
+                                                                   deadline=deadline)
+            finally:
+                profiler.dump(query, orchestration_service.geo_operator)
         return jsonify(get_qald_format_answer(answer))
     except Exception as e:
         flask_app.logger.error(f"Error: {str(e)}")
@@ -39,7 +68,89 @@ def qa():
         })
 
 
+@app.route("/qa/stream", methods=["POST", "GET"])
+def qa_stream():
+    """Server-sent events version of /qa: "provisional" and "update" events carry the best answer ranked so far,
+    "final" the answer /qa would return. Each event's data is a QALD formatted answer."""
+    if request.method == "POST":
+        query = request.form.get('query')
+        lang = request.form.get('lang', 'en')
+        no_cache = request.form.get('no_cache', 'false')
+        time_budget = request.form.get('time_budget')
+    else:
+        query = request.args.get('query')
+        lang = request.args.get('lang', 'en')
+        no_cache = request.args.get('no_cache', 'false')
+        time_budget = request.args.get('time_budget')
+    deadline = Deadline.for_request(time_budget)
+
+    flask_app.logger.info(f"{request.method} /qa/stream {query}")
+
+    def generate_events():
+        try:
+            orchestration_service = Orchestrator()
+            for event, answer in orchestration_service.answer_question_stream(
+                    query, lang, use_cache=no_cache.lower() != "true", deadline=deadline):
+                yield get_server_sent_event(event, get_qald_format_answer(answer))
+        except Exception as e:
+            flask_app.logger.error(f"Error: {str(e)}")
+            yield get_server_sent_event("final", get_qald_format_answer(Orchestrator.get_empty_answer()))
+
+    return Response(stream_with_context(generate_events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/qa/batch", methods=["POST"])
+def qa_batch():
+    body = request.get_json(silent=True)
+    # The body is either a bare array of questions or an object with the questions and options
+    if isinstance(body, list):
+        body = {"questions": body}
+    elif not isinstance(body, dict):
+        body = {}
+    questions = body.get("questions") or request.form.getlist('query')
+    lang = body.get("lang", request.form.get('lang', 'en'))
+    no_cache = str(body.get("no_cache", request.form.get('no_cache', 'false')))
+    deadline = Deadline.for_request(str(body.get("time_budget", request.form.get('time_budget', ''))))
+    if not isinstance(questions, list) or not all(isinstance(question, str) for question in questions):
+        return jsonify({"error": "questions must be a list of strings"}), 400
+    if len(questions) > flask_app.config['QA_BATCH_MAX_QUESTIONS']:
+        return jsonify({"error": f"at most {flask_app.config['QA_BATCH_MAX_QUESTIONS']} questions per batch"}), 400
+
+    flask_app.logger.info(f"{request.method} /qa/batch {len(questions)} questions")
+
+    try:
+        orchestration_service = Orchestrator()
+        answers = orchestration_service.answer_questions(questions, lang, use_cache=no_cache.lower() != "true",
+                                                         deadline=deadline)
+    except Exception as e:
+        flask_app.logger.error(f"Error: {str(e)}")
+        answers = [Orchestrator.get_empty_answer() for _ in questions]
+    return jsonify(get_qald_format_answers(answers))
+
+
+@app.route("/metrics")
+def metrics():
+    return Response(MetricsRegistry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/cache/invalidate", methods=["POST"])
+def invalidate_cache():
+    if not CacheGeneration.is_authorized(request.headers.get('X-GeoQA-Admin-Token'), request.remote_addr):
+        return jsonify({"error": "not authorized"}), 403
+    CacheGeneration.invalidate()
+    return jsonify({"invalidated": True})
+
+
+def get_server_sent_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
 def get_qald_format_answer(answer):
+    return get_qald_format_answers([answer])
+
+
+def get_qald_format_answers(answers):
     return {
         "questions": [
             {
@@ -47,5 +158,6 @@ def get_qald_format_answer(answer):
                     "answers": answer
                 }
             }
+            for answer in answers
         ]
     }
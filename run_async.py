@@ -0,0 +1,6 @@
+from aiohttp import web
+
+from geoqa.async_views import create_app
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host="0.0.0.0", port=8080)
@@ -0,0 +1,6 @@
+import sys
+
+from geoqa.service.prefork import PreforkServer
+
+if __name__ == "__main__":
+    PreforkServer(workers=int(sys.argv[1]) if len(sys.argv) > 1 else None).run()
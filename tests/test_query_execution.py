@@ -0,0 +1,154 @@
+import re
+import unittest
+from unittest import mock
+
+from geoqa import app as flask_app
+from geoqa.core.query_executor import QueryExecutor
+from geoqa.model.beans import Constants, FilledQuery, LinkedCandidate
+
+PREFIXES = "PREFIX geo: <http://www.opengis.net/ont/geosparql#>"
+
+
+def link(uri: str, category: str, term: str = "term", multiplier: int = 1) -> LinkedCandidate:
+    return LinkedCandidate(uri, term, term, term, 1.0, multiplier, 0, [Constants.WAY_CLASS], [0], [1], category)
+
+
+def select_query(entity: str, term: str = "term", multiplier: int = 1, limit: str = "") -> FilledQuery:
+    return FilledQuery(f"{PREFIXES} SELECT ?x WHERE {{ ?x a <http://c/School> . <{entity}> geo:sfContains ?x }} "
+                       f"{limit}".strip(),
+                       Constants.QUERY_FORM_SELECT, geo_operator=Constants.GEO_OPERATOR_CONTAINMENT,
+                       used_classes=[link("http://c/School", Constants.CLASS)],
+                       used_entities=[link(entity, Constants.ENTITY, term, multiplier)])
+
+
+def bindings(*values: str) -> dict:
+    return {"head": {"vars": ["x"]}, "results": {"bindings": [{"x": {"type": "uri", "value": v}} for v in values]}}
+
+
+class FakeEndpoint(object):
+    """Answers candidate queries from fixed results and batch queries by joining them over their VALUES rows."""
+    VALUES_REGEX = re.compile(r"VALUES \(([^)]*)\) \{ (.*?) \}")
+
+    def __init__(self, results: dict):
+        self.results = results
+        self.executed = []
+
+    def execute(self, query, sparql_endpoint=None, timeout=None, use_cache=True):
+        self.executed.append(query)
+        values = self.VALUES_REGEX.search(query)
+        if values is None:
+            return self.results[query]
+
+        batch_vars = [var.lstrip("?") for var in values.group(1).split()]
+        rows = [re.findall(r"<([^>]+)>", row) for row in re.findall(r"\(([^)]*)\)", values.group(2))]
+        joined = []
+        for row in rows:
+            member = select_query(row[1]).query
+            for binding in self.results[member]["results"]["bindings"]:
+                joined.append(dict(binding, **{var: {"type": "uri", "value": uri}
+                                               for var, uri in zip(batch_vars, row)}))
+        return {"head": {"vars": ["x"] + batch_vars}, "results": {"bindings": joined}}
+
+
+class QueryExecutionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = dict(flask_app.config)
+        flask_app.config.update(SPARQL_EXECUTOR="remote", QUERY_BATCHING_ENABLED=True, ABLATION_RANKING=False,
+                                METRICS_ENABLED=False)
+        QueryExecutor.invalidate_cache()
+
+    def tearDown(self):
+        flask_app.config.update(self.config)
+        QueryExecutor.invalidate_cache()
+
+    def test_batch_results_split_back_per_query(self):
+        queries = [select_query(f"http://e/{i}") for i in range(4)]
+        endpoint = FakeEndpoint({query.query: bindings(*[f"http://t/{i}/{j}" for j in range(i)])
+                                 for i, query in enumerate(queries)})
+
+        with mock.patch.object(QueryExecutor, "execute", side_effect=endpoint.execute):
+            results = QueryExecutor.execute_queries(queries)
+
+        self.assertEqual(1, len(endpoint.executed))
+        for query, result in zip(queries, results):
+            self.assertEqual(endpoint.results[query.query]["results"]["bindings"], result["results"]["bindings"])
+
+    def test_batch_skips_cached_members(self):
+        queries = [select_query(f"http://e/{i}") for i in range(3)]
+        endpoint = FakeEndpoint({query.query: bindings(f"http://t/{i}") for i, query in enumerate(queries)})
+        QueryExecutor.get_result_cache().put(QueryExecutor.get_cache_key(queries[0].query),
+                                             endpoint.results[queries[0].query])
+
+        with mock.patch.object(QueryExecutor, "execute", side_effect=endpoint.execute):
+            results = QueryExecutor.execute_queries(queries)
+
+        self.assertNotIn("http://e/0", endpoint.executed[0])
+        self.assertEqual([endpoint.results[query.query] for query in queries],
+                         [{"head": result["head"], "results": result["results"]} for result in results])
+
+    def test_symmetric_operator_argument_orders_share_canonical_key(self):
+        def borders(first: str, second: str) -> FilledQuery:
+            return FilledQuery(f"{PREFIXES} ASK {{ <{first}> geo:sfTouches <{second}> }}", Constants.QUERY_FORM_ASK,
+                               geo_operator=Constants.GEO_OPERATOR_BORDER,
+                               used_entities=[link(first, Constants.ENTITY), link(second, Constants.ENTITY)])
+
+        forward, backward = borders("http://e/a", "http://e/b"), borders("http://e/b", "http://e/a")
+        self.assertEqual(forward.get_canonical_key(), backward.get_canonical_key())
+        self.assertNotEqual(forward.get_canonical_key(), borders("http://e/a", "http://e/c").get_canonical_key())
+
+        kept = QueryExecutor.deduplicate([forward, backward])
+        self.assertEqual([forward], kept)
+        self.assertEqual([backward], forward.duplicates)
+
+    def test_deduplicate_keeps_argument_order_with_best_pre_execution_score(self):
+        def borders(first: str, second: str, multiplier: int) -> FilledQuery:
+            return FilledQuery(f"{PREFIXES} ASK {{ <{first}> geo:sfTouches <{second}> }}", Constants.QUERY_FORM_ASK,
+                               geo_operator=Constants.GEO_OPERATOR_BORDER,
+                               used_entities=[link(first, Constants.ENTITY, multiplier=multiplier),
+                                              link(second, Constants.ENTITY)])
+
+        forward, backward = borders("http://e/a", "http://e/b", 1), borders("http://e/b", "http://e/a", 3)
+
+        kept = QueryExecutor.deduplicate([forward, backward])
+        self.assertEqual([backward], kept)
+        self.assertEqual([forward], backward.duplicates)
+        self.assertEqual([], forward.duplicates)
+
+    def rank_both_modes(self, queries, endpoint):
+        flask_app.config.update(QUERY_BATCHING_ENABLED=False, QUERY_EXECUTION_WORKERS=2)
+        with mock.patch.object(QueryExecutor, "execute", side_effect=endpoint.execute):
+            flask_app.config.update(RANKING_MODE="exhaustive")
+            exhaustive = QueryExecutor().execute_and_rank(queries)
+            executed = len(endpoint.executed)
+            flask_app.config.update(RANKING_MODE="early_termination")
+            early = QueryExecutor().execute_and_rank(queries)
+        return exhaustive, early, executed, len(endpoint.executed) - executed
+
+    def test_early_termination_stops_on_bounded_candidates(self):
+        queries = [select_query(f"http://e/{i}", term="t" * (10 * (6 - i)), multiplier=i % 2 + 1, limit="LIMIT 5")
+                   for i in range(6)]
+        endpoint = FakeEndpoint({query.query: bindings(*[f"http://t/{i}/{j}" for j in range((i * 7) % 5)])
+                                 for i, query in enumerate(queries)})
+
+        exhaustive, early, exhaustive_executed, early_executed = self.rank_both_modes(queries, endpoint)
+
+        self.assertIs(exhaustive[0].query, early[0].query)
+        self.assertEqual(exhaustive[0].ranking_score, early[0].ranking_score)
+        self.assertLess(early_executed, exhaustive_executed)
+
+    def test_early_termination_executes_unbounded_candidates(self):
+        # The candidate with the lowest pre-execution score wins on the number of its results
+        queries = [select_query(f"http://e/{i}", term="t" * (10 * (4 - i))) for i in range(4)]
+        counts = [2, 1, 0, 40]
+        endpoint = FakeEndpoint({query.query: bindings(*[f"http://t/{i}/{j}" for j in range(counts[i])])
+                                 for i, query in enumerate(queries)})
+
+        exhaustive, early, _, _ = self.rank_both_modes(queries, endpoint)
+
+        self.assertIs(queries[3], exhaustive[0].query)
+        self.assertEqual([(r.query, r.ranking_score) for r in exhaustive], [(r.query, r.ranking_score) for r in early])
+
+
+if __name__ == '__main__':
+    unittest.main()
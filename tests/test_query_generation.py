@@ -0,0 +1,53 @@
+import unittest
+
+from geoqa.core.query_executor import QueryExecutor
+from geoqa.core.query_generator import QueryGenerator
+from geoqa.model.beans import Constants, LinkingResponse, QuestionFeatures
+
+
+def link(uri: str, start_index: int) -> dict:
+    return {"uri": uri, "label": "label", "searchTerm": "term", "originalTerm": "term", "esScore": 1.0,
+            "multiplier": 1, "levensteinDistance": 0, "types": [Constants.WAY_CLASS], "startIndex": [start_index],
+            "endIndex": [start_index + 1]}
+
+
+def generate(geo_operator: str, query_form: str, classes=(), entities=()) -> list:
+    linking_info = LinkingResponse("question", list(classes), [], list(entities))
+    return QueryGenerator("question", geo_operator, linking_info, QuestionFeatures(query_form, False)) \
+        .generate_queries()
+
+
+class QueryGenerationTest(unittest.TestCase):
+
+    def test_entity_entity_pattern_fills_each_entity_once(self):
+        queries = generate(Constants.GEO_OPERATOR_BORDER, Constants.QUERY_FORM_ASK,
+                           entities=[link("http://e/a", 0), link("http://e/b", 5)])
+
+        self.assertEqual(2, len(queries))
+        for query in queries:
+            first, second = [entity.uri for entity in query.used_entities]
+            self.assertIn(f"<{first}> geo:hasGeometry ?aGeom", query.query)
+            self.assertIn(f"<{second}> geo:hasGeometry ?tGeom", query.query)
+
+    def test_class_class_pattern_fills_each_class_once(self):
+        queries = generate(Constants.GEO_OPERATOR_BORDER, Constants.QUERY_FORM_SELECT,
+                           classes=[link("http://c/A", 0), link("http://c/B", 5)])
+
+        self.assertEqual({("http://c/A", "http://c/B"), ("http://c/B", "http://c/A")},
+                         {tuple(c.uri for c in query.used_classes) for query in queries})
+        for query in queries:
+            first, second = [c.uri for c in query.used_classes]
+            self.assertIn(f"?a a <{first}> ;", query.query)
+            self.assertIn(f"?b a <{second}> ;", query.query)
+
+    def test_argument_orders_of_borders_are_deduplicated(self):
+        queries = generate(Constants.GEO_OPERATOR_BORDER, Constants.QUERY_FORM_ASK,
+                           entities=[link("http://e/a", 0), link("http://e/b", 5)])
+
+        kept = QueryExecutor.deduplicate(queries)
+        self.assertEqual([queries[0]], kept)
+        self.assertEqual([queries[1]], kept[0].duplicates)
+
+
+if __name__ == '__main__':
+    unittest.main()